@@ -4,6 +4,6 @@ Author: C. Grima (cyril.grima@gmail.com)
 
 __author__ = 'Cyril Grima'
 
-__all__ = ['do', 'get', 'read']
+__all__ = ['bathymetry', 'do', 'geo', 'get', 'metrics', 'read']
 
-from . import do, get, read
+from . import bathymetry, do, geo, get, metrics, read
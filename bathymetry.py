@@ -0,0 +1,110 @@
+"""
+Depth of subsurface echoes from their delay to the surface echo
+Author: Cyril Grima <cyril.grima@gmail.com>
+"""
+
+import functools
+import numpy as np
+import scipy.constants as ct
+
+
+def eps2dns(eps):
+    """Convert permittivity into dry-snow density [kg.m^{-3}]
+    Based on Kovacs et al. [1995]
+    """
+    return (np.sqrt(eps)-1)/845e-6
+
+
+def dns2eps(dns):
+    """Convert dry-snow density [kg.m^{-3}] into permittivity
+    Based on Kovacs et al. [1995]
+    """
+    return (1+845e-6*dns)**2
+
+
+def sorge(dns0, z, zp, dns_ice=917.):
+    """Density profile following Sorge's law
+    ARGUMENTS
+        dns0 : float (surface density [kg.m^{-3}])
+        z : array (depth [m])
+        zp : float (depth of the firn/ice transition [m])
+    """
+    return dns_ice - (dns_ice-dns0)*np.exp(-1.9*z/zp)
+
+
+def depth(eps, delay, zp=(19., 129.), bdw=15e6, zmax=5000., nz=5000,
+          eps_grid=(1., 3.2, 221)):
+    """Depth of subsurface echoes from the surface permittivity and the
+    delay between the surface and subsurface echoes, assuming a Sorge's law
+    density profile (vectorized version of utils.dns_depth)
+
+    The two-way delay profiles are tabulated once on a grid of surface
+    permittivities. Each (eps, delay) is resolved with a binary search in
+    the two bracketing profiles and a linear interpolation in eps. Results
+    on the grid are those of utils.dns_depth. Between grid rows, the
+    interpolation departs from it by up to ~0.5 m with the default grid.
+    Permittivities out of eps_grid give nans
+    ARGUMENTS
+        eps : array (permittivity at the surface)
+        delay : array (delay between surface and subsurface echoes [s])
+        zp : (float, float) (depths of the firn/ice transition to consider)
+        bdw : float (radar bandwidth [Hz])
+        zmax, nz : float, int (depth profile, as linspace(0, zmax, nz))
+        eps_grid : (float, float, int) (tabulated permittivities, as linspace)
+    OUTPUT
+        depth : estimated depth [m] (nan if out of the depth profile or of
+                eps_grid)
+        uncertainty : +/- uncertainty on depth [m]
+        dns_at_depth : estimated density at depth [kg.m^{-3}]
+    """
+    eps = np.asarray(eps, dtype=float)
+    delay = np.asarray(delay, dtype=float)
+    z, grid, offset, dt = _table(tuple(zp), zmax, nz, eps_grid)
+
+    # Bracketing rows in the permittivity grid
+    x = np.interp(eps, grid, np.arange(grid.size))
+    x = np.where(np.isfinite(x), x, 0.)
+    j = np.minimum(np.floor(x).astype(int), grid.size-2)
+    f = x - j
+
+    d = []
+    for k in range(len(zp)):
+        d0 = _search(z, offset, dt[k], j, delay)
+        d1 = _search(z, offset, dt[k], j+1, delay)
+        d.append((1-f)*d0 + f*d1)
+    d_a, d_b = d
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dns0 = eps2dns(eps)
+        uncertainty = np.abs(d_a-d_b)/2. + ct.c/(2*bdw*np.sqrt(eps))/2.
+        depth = np.minimum(d_a, d_b) + np.abs(d_a-d_b)/2.
+        dns_at_depth = (sorge(dns0, d_a, zp[0]) + sorge(dns0, d_b, zp[1]))/2.
+
+    with np.errstate(invalid='ignore'):
+        bad = ~np.isfinite(eps) | ~np.isfinite(delay) | (eps < grid[0]) | (eps > grid[-1])
+    return (np.where(bad, np.nan, depth), np.where(bad, np.nan, uncertainty),
+            np.where(bad, np.nan, dns_at_depth))
+
+
+@functools.lru_cache(maxsize=4)
+def _table(zp, zmax, nz, eps_grid):
+    """Depth profile, permittivity grid and two-way delay profiles (one
+    [eps, z] table per firn/ice transition depth). Each row of a table is
+    offset above the previous one, so that all rows are searched at once
+    """
+    z = np.linspace(0, zmax, nz)
+    grid = np.linspace(*eps_grid)
+    dns0 = eps2dns(grid)[:, np.newaxis]
+    dt = [np.cumsum(2*np.sqrt(dns2eps(sorge(dns0, z, i)))/ct.c, axis=1) for i in zp]
+    offset = 2*np.max([i.max() for i in dt])
+    rows = np.arange(grid.size)[:, np.newaxis]*offset
+    return z, grid, offset, [(i + rows).ravel() for i in dt]
+
+
+def _search(z, offset, dt, row, delay):
+    """Depth of the first sample of the delay profile dt[row] that reaches
+    delay (nan if delay is beyond the profile)
+    """
+    delay = np.clip(np.where(np.isfinite(delay), delay, 0.), 0, 0.75*offset)
+    w = np.searchsorted(dt, delay + row*offset, side='left') - row*z.size
+    return np.where(w < z.size, z[np.minimum(w, z.size-1)], np.nan)
@@ -0,0 +1,110 @@
+"""
+Benchmarks for the icecap readers
+Author: Cyril Grima <cyril.grima@gmail.com>
+"""
+
+import contextlib
+import icecap as icp
+import icecap.synth
+import io
+import numpy as np
+import os
+import pandas as pd
+import tempfile
+import time
+import tracemalloc
+
+
+def ztim(nlines=2000000, regex=True):
+    """Time the ztim decoders on a synthetic file of nlines records
+    ARGUMENTS
+        nlines : int (number of lines in the synthetic file)
+        regex : bool (also time the python regex parser, which is slow)
+    OUTPUT
+        dict : elapsed time [s] for each decoder and speedup
+    """
+    out = {'nlines':nlines}
+    with tempfile.TemporaryDirectory() as folder:
+        fil = os.path.join(folder, 'ztim_DNhH')
+        icp.synth.write_ztim(fil, np.arange(nlines)*250 + 123456789)
+
+        t1 = time.time()
+        a = icp.read._ztim_c(fil)
+        out['c'] = time.time() - t1
+        print('C decoder:     %.2f s. (%.0f lines/s)' % (out['c'], nlines/out['c']))
+
+        if regex is True:
+            t1 = time.time()
+            b = icp.read._ztim_regex(fil)
+            out['regex'] = time.time() - t1
+            out['speedup'] = out['regex']/out['c']
+            print('regex decoder: %.2f s. (%.0f lines/s)' % (out['regex'], nlines/out['regex']))
+            print('speedup: x%.1f' % out['speedup'])
+            for i in [1, 3, 5]:
+                assert np.array_equal(a[i].values, b[i].values)
+    return out
+
+
+def suite(root=None, npst=4, nframes=20000, pik='srf_syn', rsr=False):
+    """Time the read, get and do stages over a synthetic WAIS hierarchy
+    (see synth.tree). Caches are cleared before each stage
+    ARGUMENTS
+        root : string (where to build the hierarchy, default: temporary)
+        npst : int (number of PSTs)
+        nframes : int (number of 1-m frames per PST)
+        rsr : bool (also time do.rsr_inline, which is slow)
+    OUTPUT
+        DataFrame : time [s], throughput [frames/s] and peak memory [MB]
+                    of each stage
+    """
+    with contextlib.ExitStack() as stack:
+        if root is None:
+            root = stack.enter_context(tempfile.TemporaryDirectory())
+        code_path = icp.synth.tree(root, npst=npst, nframes=nframes, pik=pik)
+        cwd = os.getcwd()
+        os.chdir(code_path)
+        stack.callback(os.chdir, cwd)
+
+        psts = icp.get.pst('*')
+        p = icp.get.params()
+        each = lambda func: (lambda: [func(i) for i in psts])
+        stages = [
+            ('read.ztim', each(lambda i: icp.read.ztim(p['foc_path'] + '/' + i + '/ztim_DNhH'))),
+            ('read.norm', each(lambda i: icp.read.norm(i, 'GPS', ['lon_ang', 'lat_ang'], interp=True))),
+            ('read.targ', each(lambda i: icp.read.targ(i, 'treg', 'TRJ_JKB0', 'ztim_llzrphsaaa', column=[-7, -1]))),
+            ('read.pik', each(lambda i: icp.read.pik(i, pik))),
+            ('read.rsr', each(lambda i: icp.read.rsr(i, pik))),
+            ('get.pst', each(lambda i: icp.get.pst(i))),
+            ('get.geo', each(lambda i: icp.get.geo(i, cache=False))),
+            ('get.signal', each(lambda i: icp.get.signal(i, pik))),
+            ('do.surface_coefficients', lambda: icp.do.surface_coefficients('*', pik, force=True)),
+            ('do.surface_properties', lambda: icp.do.surface_properties('*', pik, force=True)),
+            ('do.gather', lambda: icp.do.gather('*', pik, fil=root + '/gather')),
+            ]
+        if rsr is True:
+            stages.append(('do.rsr_inline', lambda: icp.do.rsr_inline('*', pik, force=True, nbcores=1, verbose=False)))
+
+        out = []
+        for name, func in stages:
+            t = _run(func)
+            tracemalloc.start() # separate run, tracemalloc slows down python
+            _run(func)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            out.append({'stage':name, 'time':t, 'frames/s':npst*nframes/t, 'peak [MB]':peak/1e6})
+            print('%-25s %7.2f s. %12.0f frames/s %8.1f MB' % (name, t, npst*nframes/t, peak/1e6))
+    return pd.DataFrame(out)
+
+
+def _run(func):
+    """Run a benchmark stage with cold caches and no output. Return the
+    elapsed time [s]
+    """
+    icp.read._timebase.cache_clear()
+    icp.read._norm_plan.cache_clear()
+    icp.read._pik_cached.cache_clear()
+    icp.get._season_db.cache_clear()
+    t1 = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+    return time.time() - t1
@@ -3,15 +3,24 @@ Various tools to process WAIS data
 Author: Cyril Grima <cyril.grima@gmail.com>
 """
 
+import concurrent.futures
 import fnmatch
+import functools
+import glob
+import hashlib
 import numpy as np
 import icecap as icp
+import icecap.geo
+import icecap.metrics
 import inspect
+import itertools
+import json
 import os
 import rsr.run as run
 import rsr.fit as fit
 import rsr.utils as utils
 import rsr.invert as invert
+import scipy.constants as ct
 #import string
 import subradar as sr
 import time
@@ -21,127 +30,480 @@ import multiprocessing
 
 
 def timing(func):
-   """Outputs the time a function takes to execute.
+   """Outputs the time a function takes to execute, and records its
+   metrics (see metrics.stage)
    """
+   func = icp.metrics.stage(func)
+   @functools.wraps(func)
    def func_wrapper(*args, **kwargs):
        t1 = time.time()
-       func(*args, **kwargs)
+       out = func(*args, **kwargs)
        t2 = time.time()
        print("- Processed in %.1f s.\n" % (t2-t1))
+       return out
    return func_wrapper
 
 
 
+_LOOP_FUNCS = {} # Functions decorated by loop, by name (for worker processes)
+
+
 def loop(func):
-    """Decorator for processing sequentialy over multiple PSTs
+    """Decorator for processing over multiple PSTs and picks
+    The nbjobs keyword sets how many (PST, pick) jobs run in parallel.
+    A failing job is reported without stopping the others.
+    Return a summary of the jobs (status and time)
     """
-    def func_wrapper(*args, **kwargs):
-        pst_list = icp.get.pst(args[0])
+    name = func.__module__ + '.' + func.__qualname__
+    _LOOP_FUNCS[name] = func
 
-        if 'from_process' in kwargs:
-            process = kwargs['from_process']
-        elif 'process' not in kwargs:
-            process = None
+    @functools.wraps(func)
+    def func_wrapper(*args, nbjobs=1, **kwargs):
+        pst_list = icp.get.pst(args[0])
+        process = kwargs.get('from_process', kwargs.get('process'))
 
-        _processes = []
+        jobs, out = [], []
         for pst_i in pst_list:
-            product_list, pik_list = icp.get.pik(pst_i, process=process, **kwargs)
-            for i, pik_i in enumerate(pik_list):
-                if fnmatch.filter([pik_i], args[1]):
-                    func(pst_i, pik_i, **kwargs)
-#                    p = multiprocessing.Process(target=func, args=(pst_i, pik_i), kwargs=kwargs)
-#                    p.start()
-#                    _processes.append(p)
-#        for p in _processes:
-#            p.join()
+            product_list, pik_list = icp.get.pik(pst_i, process=process)
+            pik_list = fnmatch.filter(dict.fromkeys(pik_list), args[1])
+            if not pik_list:
+                out.append({'pst':pst_i, 'pik':None, 'status':'skipped',
+                            'time':0., 'error':'No pik matching ' + args[1]})
+            for pik_i in pik_list:
+                jobs.append((name, pst_i, pik_i, kwargs))
+
+        t1 = time.time()
+        if nbjobs <= 1:
+            out += [_loop_job(job) for job in jobs]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(nbjobs) as pool:
+                out += list(pool.map(_loop_job, jobs))
+
+        out = pd.DataFrame(out, columns=['pst', 'pik', 'status', 'time', 'error'])
+        print('- %s: %d succeeded, %d failed, %d skipped in %.1f s.' % (
+              func.__name__, np.sum(out.status == 'succeeded'),
+              np.sum(out.status == 'failed'), np.sum(out.status == 'skipped'),
+              time.time() - t1))
+        return out
     return func_wrapper
 
 
+def _loop_job(job):
+    """Run one (PST, pick) job of a function decorated by loop
+    """
+    name, pst, pik, kwargs = job
+    out = {'pst':pst, 'pik':pik, 'status':'succeeded', 'error':''}
+    t1 = time.time()
+    try:
+        res = _LOOP_FUNCS[name](pst, pik, **kwargs)
+        if isinstance(res, Skipped):
+            out['status'], out['error'] = 'skipped', str(res)
+    except Exception as e:
+        out['status'] = 'failed'
+        out['error'] = repr(e)
+        print('FAILED: ' + pst + ' ' + pik + ' ' + repr(e))
+    out['time'] = time.time() - t1
+    return out
+
+
+
+def make(deps):
+    """Decorator for the incremental processing of a product
+    deps(pst, pik, **kwargs) gives the product file and the files it is
+    computed from. The product is skipped when it is up to date, i.e. its
+    inputs are identical in content and its parameters unchanged (as
+    recorded in <product>.deps). A product without record is rebuilt.
+    force=True rebuilds it anyway, dry_run=True only tells what would be
+    rebuilt. A product skipped, or not written by the call, is not recorded
+    and a Skipped (the reason) is returned instead, so that loop reports it
+    as skipped
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def func_wrapper(pst, pik, force=False, dry_run=False, **kwargs):
+            if kwargs.get('save', True) is False:
+                return func(pst, pik, **kwargs)
+            target, inputs = deps(pst, pik, **kwargs)
+            params = _make_params(func, pst, pik, kwargs)
+            reason = 'forced' if force is True else _outdated(target, inputs, params)
+            if reason is None:
+                print('UP-TO-DATE: ' + target)
+                return Skipped('up to date')
+            if dry_run is True:
+                print('TO REBUILD: ' + target + ' (' + reason + ')')
+                return Skipped('dry run: ' + reason)
+            before = _stat(target)
+            out = func(pst, pik, **kwargs)
+            after = _stat(target)
+            if after is None or after == before: # not written by func
+                return Skipped('not built')
+            _make_record(target, inputs, params)
+            return out
+        return func_wrapper
+    return decorator
+
+
+class Skipped(str):
+    """Returned instead of a product that has not been built (the reason)
+    """
+
+
+def _stat(fil):
+    """Inode and modification time of a file (None if missing)
+    """
+    try:
+        s = os.stat(fil)
+    except OSError:
+        return None
+    return s.st_ino, s.st_mtime_ns
+
+
+_MAKE_IGNORED = ['pst', 'pik', 'bed_pik', 'save', 'nbcores', 'verbose'] # Not parameters
+
+
+def _make_params(func, pst, pik, kwargs):
+    """Parameters of a product (arguments of func, including defaults)
+    """
+    sig = inspect.signature(func)
+    a = sig.bind(pst, pik, **kwargs)
+    a.apply_defaults()
+    out = {}
+    for key, val in a.arguments.items():
+        if sig.parameters[key].kind == inspect.Parameter.VAR_KEYWORD:
+            out.update({i:repr(j) for i, j in val.items()})
+        else:
+            out[key] = repr(val)
+    return {key:val for key, val in sorted(out.items()) if key not in _MAKE_IGNORED}
+
+
+def _file_state(fil, checksum=True):
+    """Modification time, size and checksum of a file (None if missing)
+    """
+    if not os.path.isfile(fil):
+        return None
+    out = {'mtime':os.path.getmtime(fil), 'size':os.path.getsize(fil)}
+    if checksum is True:
+        h = hashlib.sha1()
+        with open(fil, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        out['sha1'] = h.hexdigest()
+    return out
+
+
+def _make_record(target, inputs, params):
+    """Record the inputs and parameters a product has been built from
+    """
+    record = {'params':params, 'inputs':{i:_file_state(i) for i in inputs}}
+    with open(target + '.deps', 'w') as f:
+        json.dump(record, f, indent=1)
+
 
-def save(data, target):
-    """Save a dictionnary of data in a text file
+def _outdated(target, inputs, params):
+    """Reason why a product has to be rebuilt, or None if it is up to date
+    """
+    if not os.path.isfile(target):
+        return 'missing'
+    if not os.path.isfile(target + '.deps'): # parameters unknown
+        return 'no record'
+
+    with open(target + '.deps') as f:
+        record = json.load(f)
+    if record['params'] != params:
+        return 'parameters changed'
+    if sorted(record['inputs']) != sorted(inputs):
+        return 'inputs changed'
+    touched = False
+    for i in inputs:
+        old = record['inputs'][i]
+        new = _file_state(i, checksum=False)
+        if old is None or new is None:
+            if old != new:
+                return 'changed ' + i
+        elif (old['mtime'], old['size']) != (new['mtime'], new['size']):
+            if _file_state(i)['sha1'] != old['sha1']:
+                return 'changed ' + i
+            touched = True
+    if touched: # same content, refresh the record
+        _make_record(target, inputs, params)
+    return None
+
+
+def _product_files(pst, pik, product='MagHiResInco1', process=None, **kwargs):
+    """Files involved in the processing of a (PST, pick)
+    """
+    p = icp.get.params()
+    if process is None:
+        process = p['process']
+    las = p['norm_path'] + '/' + pst + '/LAS_' + pst.split('/')[1][0:3] + 'a/'
+    return {'pik':p['pik_path'].replace(p['process'], '') + process + '/' + pst + '/' + product + '.' + pik,
+            'rsr':p['rsr_path'].replace(p['process'], '') + process + '/' + pst + '/' + product + '.' + pik,
+            'target':p['rsr_path'] + '/' + pst + '/' + product + '.' + pik,
+            'range':[p['foc_path'] + '/' + pst + '/ztim_DNhH', las + 'las_rng', las + 'syn_ztim'],
+            'treg':p['treg_path'] + '/' + pst + '/TRJ_JKB0/ztim_llzrphsaaa.bin'}
+
+
+
+def save(data, target, binary=False):
+    """Save a dictionnary of data in a text file. If binary is True (or a
+    float dtype such as 'float32'), save it in a npy file with one named
+    field per column instead (see read.table). Keys may be prefixed by
+    their rank (e.g. '0_Rsc')
     """
-    df = pd.DataFrame(data)
-    df.to_csv(target, sep='\t', index=False, float_format='%.7f', header=False, na_rep='nan')
+    if binary is not False:
+        dtype = 'float64' if binary is True else binary
+        names = [key.split('_', 1)[1] if key.split('_', 1)[0].isdigit() else key
+                 for key in data]
+        a = np.zeros(len(next(iter(data.values()))), dtype=[(i, dtype) for i in names])
+        for name, val in zip(names, data.values()):
+            a[name] = val
+        with open(target, 'wb') as f:
+            np.save(f, a)
+    else:
+        df = pd.DataFrame(data)
+        df.to_csv(target, sep='\t', index=False, float_format='%.7f', header=False, na_rep='nan')
     print('CREATED: ' + target)
 
 
 
-def rsr(pst, pik, frame, **kwargs):
+def rsr(pst, pik, frame=None, region=None, **kwargs):
     """Apply RSR from a section of a transect
+    Instead of frame ([first, last]), region gives a geographic window (see
+    geo.query). It is resolved to frames on every PST matching pst that
+    crosses it (see geo.frames), and the RSR is applied to the amplitudes
+    of all these frames
     """
-    val = icp.get.signal(pst, pik, **kwargs)
-    amp = 10**(val[frame[0]:frame[1]]/20.)
-    return run.processor(amp)
+    if frame is None and region is None:
+        raise ValueError('do.rsr needs a frame or a region')
+    if region is None:
+        val = icp.get.signal(pst, pik, frame=slice(frame[0], frame[1]), **kwargs)
+        return run.processor(10**(val/20.))
+
+    frames = icp.geo.frames(region, pattern=pst, pik=pik)
+    amp = []
+    for pst_i, frame_i in frames.items():
+        val = icp.get.signal(pst_i, pik, frame=frame_i, **kwargs)
+        print('- %s: %d frames' % (pst_i, frame_i.size))
+        amp.append(10**(val/20.))
+    if not amp:
+        raise ValueError('No frame of ' + pik + ' in ' + repr(region))
+    return run.processor(np.concatenate(amp))
     #return fit.lmfit(amp)
 
 
 
+def calibration(pst, pik, frame=None, region=None, eps=3.15, frq=60e6, gains=None,
+                gain=0, **kwargs):
+    """Gain with which the SPM permittivity of a reference window (see
+    do.rsr with frame or region) is eps, as reported in calibration.md
+    The RSR is fitted once. A gain is a constant offset of pc and pn [dB]
+    that leaves pc-pn, hence sh, unchanged, so that the gain giving eps is
+    solved analytically from the SPM reflection coefficient
+    ARGUMENTS
+        eps : float (target permittivity, e.g. 3.15 for blue ice)
+        frq : float (radar frequency [Hz])
+        gains : array (gains of the eps/sh table, default: +/- 2 dB around
+                the solution by 0.1 dB)
+        gain : float (gain of the fit, see get.signal)
+    OUTPUT
+        dict : {'gain':float, 'eps':float, 'sh':float, 'fit':Statfit,
+                'table':DataFrame (gain, pc, pn, eps, sh)}
+    """
+    fit = rsr(pst, pik, frame=frame, region=region, gain=gain, **kwargs)
+    pwr = fit.power()
+    sh = spm(frq, pwr['pc'], pwr['pn'])['sh']
+
+    # pc giving eps at this sh
+    k = 2*ct.pi*frq/ct.c
+    r = (1 - np.sqrt(eps))/(1 + np.sqrt(eps))
+    pc = 10*np.log10(r**2*np.exp(-(2*k*sh)**2))
+    out = {'gain':gain + pc - pwr['pc'], 'fit':fit}
+    out.update({key:val.item() for key, val in spm(frq, pc, pwr['pn'] + pc - pwr['pc']).items()})
+
+    if gains is None:
+        gains = out['gain'] + np.arange(-20, 21)*.1
+    offset = np.asarray(gains, dtype=float) - gain
+    table = spm(frq, pwr['pc'] + offset, pwr['pn'] + offset)
+    out['table'] = pd.DataFrame({'gain':gains, 'pc':pwr['pc'] + offset,
+                                 'pn':pwr['pn'] + offset, **table})
+    print('- gain = %.2f dB gives, eps = %.3f, sh = %.2e m' % (out['gain'], out['eps'], out['sh']))
+    return out
+
+
+
+def _rsr_inline_deps(pst, pik, **kwargs):
+    f = _product_files(pst, pik, **kwargs)
+    return f['target'], [f['pik']] + f['range']
+
+
 @loop
+@make(_rsr_inline_deps)
 @timing
-def rsr_inline(pst, pik, save=True, product='MagHiResInco1', nbcores=4, **kwargs):
+def rsr_inline(pst, pik, save=True, product='MagHiResInco1', nbcores=4,
+               binary=False, **kwargs):
     """Process RSR along a profile
+    Windows are appended to <product file>.ckpt as they complete, which
+    becomes the product file at the end. An interrupted run with the same
+    parameters resumes at the first missing window. binary saves the
+    product in binary (see save)
     """
     p = icp.get.params()
 
     val = icp.get.signal(pst, pik, product=product, air_loss=False, **kwargs)
     amp = 10**(val/20)
-    b = run.along(amp, nbcores=nbcores, **kwargs)
-
-    data = pd.DataFrame({'1':b['xa'].values,
-                         '2':b['xo'].values,
-                         '3':b['xb'].values,
-                         '4':b['pt'].values,# + diff,
-                         '5':b['pc'].values,# + diff,
-                         '6':b['pn'].values,# + diff,
-                         '7':b['mu'].values,
-                         '8':b['crl'].values,
-                         '9':b['chisqr'].values}
-                         )
+    w = run.frames(np.arange(len(amp)), **kwargs)
+    icp.metrics.frames(len(amp))
 
+    start, f = 0, None
     if save is True:
         folder = p['rsr_path'] + '/' + pst
         if not os.path.exists(folder):
             os.makedirs(folder)
-        data.to_csv(folder + '/' + product+'.'+pik, sep='\t', float_format='%.7f',
-                    na_rep='nan', header=False, index=False)
-        print('CREATED: ' + folder + '/' + product+'.'+pik)
+        target = folder + '/' + product+'.'+pik
+        params = _make_params(rsr_inline, pst, pik,
+                              dict(product=product, binary=binary, **kwargs))
+        start = _checkpoint(target + '.ckpt', w['xa'], params)
+        if start > 0:
+            print('RESUMED: ' + target + ' at window %d/%d' % (start, w['xa'].size))
+        f = open(target + '.ckpt', 'a')
+
+    # Checkpoint of a binary product keeps full precision
+    fmt = '\t'.join(['%d', '%.7f', '%d'] + ['%.7f' if binary is False else '%.17g']*6) + '\n'
+    try:
+        for i, b in enumerate(_along(amp, w, start=start, nbcores=nbcores, **kwargs), start):
+            line = fmt % (w['xa'][i], w['xo'][i], w['xb'][i], b['pt'], b['pc'], b['pn'],
+                          b['mu'], b['crl'], b['chisqr'])
+            if f is not None:
+                f.write(line)
+                f.flush()
+    finally:
+        if f is not None:
+            f.close()
+
+    if save is True and binary is not False:
+        a = icp.read.table(target + '.ckpt', RSR_COLUMNS)
+        icp.do.save(a, target, binary=binary)
+        os.remove(target + '.ckpt')
+    elif save is True:
+        os.replace(target + '.ckpt', target)
+        print('CREATED: ' + target)
+    if save is True:
+        os.remove(target + '.ckpt.json')
+
+
+RSR_COLUMNS = ['xa', 'xo', 'xb', 'pt', 'pc', 'pn', 'mu', 'crl', 'chisqr'] # rsr_inline output
+
+
+def _along(amp, w, start=0, nbcores=1, batch=64, **kwargs):
+    """Same as rsr.run.along, but yield the results window by window from
+    the window start on. Jobs are submitted by batches, so that memory
+    does not grow with the length of the profile
+    """
+    verbose = kwargs.get('verbose', True)
+    jobs = ({'amp':amp[ai:bi], **kwargs, 'ID':xo}
+            for ai, bi, xo in zip(w['xa'][start:], w['xb'][start:], w['xo'][start:]))
+    pool = multiprocessing.Pool(nbcores) if nbcores > 1 else None
+    try:
+        while True:
+            chunk = list(itertools.islice(jobs, batch*max(nbcores, 1)))
+            if not chunk:
+                break
+            if pool is None:
+                results = map(run.processor_mp_, chunk)
+            else:
+                results = pool.imap(run.processor_mp_, chunk)
+            for a in results:
+                if verbose:
+                    run.cb_processor(a)
+                yield {**a.values, **a.power(), 'crl':a.crl(), 'chisqr':a.chisqr}
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def _checkpoint(fil, xa, params):
+    """Number of windows already in a checkpoint file. A partial last line
+    is dropped, and the file is reset if it does not match the windows xa
+    or if it was computed with other parameters (as recorded in
+    <checkpoint>.json)
+    """
+    if os.path.isfile(fil + '.json'):
+        with open(fil + '.json') as f:
+            old = json.load(f)
+    else:
+        old = None
+    buf = b''
+    if os.path.isfile(fil) and old == params:
+        with open(fil, 'rb') as f:
+            buf = f.read()
+    buf = buf[:buf.rfind(b'\n')+1]
+    done = [int(float(i.split(b'\t')[0])) for i in buf.splitlines()]
+    if len(done) > xa.size or not np.array_equal(done, xa[:len(done)]):
+        done, buf = [], b''
+    with open(fil + '.json', 'w') as f:
+        json.dump(params, f, indent=1)
+    with open(fil, 'wb') as f:
+        f.write(buf)
+    return len(done)
 
 
 
-@timing
 @loop
-def topik1m(pst, pik, from_process='pik1', from_product='MagLoResInco1', to_product='MagHiResInco1'):
+@timing
+def topik1m(pst, pik, from_process='pik1', from_product='MagLoResInco1',
+            to_product='MagHiResInco1', window=10, **kwargs):
     """ Inteprolate any pik file into 1m sampling
+    The pick samples are interpolated in time from the low-resolution
+    frames (ztim_DNhH of the CMP folder of from_process) onto the 1-m FOC
+    frames. The echo is then re-picked at the maximum of to_product within
+    +/- window samples (see read.cmp and read.echo)
+    The target holds only the P records (P, sample, frame, value [dB*1000])
+    that pk3 wrote. Unlike the former 'cat LU P' output, it has no pick
+    lines from pik4Hzto1m before them. read.pik only reads P records
         NOTE: at this point, from_process is mandatory for @loop to work
     """
     p = icp.get.params()
 
     source = p['pik_path'].replace( p['process'], '') + from_process + '/' + pst + '/' + from_product + '.' + pik
-    bxds = p['cmp_path'] + '/' + pst + '/'+ to_product
-    sweep = '/'.join([p['sweep_path'], pst, 'sweeps'])
-
-    test = icp.read.isfile(source) * icp.read.isfile(bxds) * icp.read.isfile(sweep, verbose=False)
-    if test == 0: return
+    source_ztim = p['cmp_path'].replace( p['process'], '') + from_process + '/' + pst + '/ztim_DNhH'
 
-    if not os.path.exists(p['pik_path'] + '/' + pst):
-        os.makedirs(p['pik_path'] + '/' + pst)
+    test = icp.read.isfile(source) * icp.read.isfile(source_ztim)
+    if test == 0: return Skipped('missing input')
+    data = icp.read.cmp(pst, product=to_product, **kwargs)
+    if data is None: return Skipped('missing input')
 
     target = p['pik_path'] + '/' + pst + '/'+ to_product + '.' + pik
-    LU = target + '_LU'
-    P = target + '_P'
-    os.system('mkdir -p ' + p['pik_path'] + '/' + pst)
-    os.system('pik4Hzto1m ' + pst + ' < ' + source + ' > ' + LU)
-    os.system('pk3 3200 0 3200 ' + bxds + ' < ' + LU + ' > ' + P)
-    os.system('cat ' + LU + ' ' + P + ' > ' + target)
-    os.system('rm -f ' + LU + ' ' + P)
+
+    # Pick line on the 1-m frames
+    a = icp.read._pik_records(source)
+    a = a[np.isfinite(a[:, 1]) & np.isfinite(a[:, 2])]
+    a = a[np.argsort(a[:, 2], kind='stable')]
+    y_lo = a[:, 2].astype(int)
+    t_lo = icp.read.timebase(pst, fil=source_ztim)[y_lo]
+    t_1m = icp.read.timebase(pst)
+    frame = np.arange(t_1m.size)
+    i = np.searchsorted(t_lo, t_1m)
+    # Not across gaps in the low-resolution picks
+    inside = (i > 0) & (i < t_lo.size)
+    inside[inside] = np.diff(y_lo)[i[inside]-1] <= 1
+    inside |= np.isin(t_1m, t_lo)
+    frame = frame[inside]
+    sample = np.round(np.interp(t_1m[inside], t_lo, a[:, 1])).astype(int)
+    sample, val = icp.read.echo(data, frame, sample, window=window)
+    keep = np.isfinite(val)
+
+    with icp.read.atomic(target) as fo:
+        for i, j, k in zip(sample[keep], frame[keep], val[keep]):
+            fo.write('P\t%d\t%d\t%d\n' % (i, j, k))
     print('CREATED: ' + target)
 
 
 @loop
 @timing
 def gather(pst, pik, fil=None, product='MagHiResInco1', **kwargs):
-    """Gather data in a text file
+    """Gather data in one npz partition per PST and pick
+    fil is the partition folder (default: <season>_gather). Read the
+    gathered data back with read.gather
     """
     p = icp.get.params()
     a = pd.DataFrame()
@@ -151,7 +513,7 @@ def gather(pst, pik, fil=None, product='MagHiResInco1', **kwargs):
     r = icp.read.rsr(pst, pik, **kwargs)
 
     if os.path.isfile(p['rsr_path'] + '/' + pst + '/' + product + '.' + pik ):
-        xo = [np.int(i) for i in r['xo']]
+        xo = r['xo'].astype(int)
         a['pst'] = np.full(len(r['xo']), pst)
         a['pik'] = np.full(len(r['xo']), pik)
         a['xo'] = xo
@@ -159,19 +521,11 @@ def gather(pst, pik, fil=None, product='MagHiResInco1', **kwargs):
         a['Pst'] = r['pt']
         a['Psc'] = r['pc']
         a['Psn'] = r['pn']
-        a['longitude'] = icp.get.longitude(pst)[xo]
-        a['latitude'] = icp.get.latitude(pst)[xo]
-        a['surface_range'] = icp.get.surface_range(pst)[xo]
-        try:
-            a['roll'] = icp.get.roll(pst)[xo]
-        except TypeError:
-            pass
-        try:
-            a['ice_thickness'] = icp.get.ice_thickness(pst)[xo]
-        except TypeError:
-            pass
+        geo = icp.get.geo(pst)
+        for key in ['longitude', 'latitude', 'surface_range', 'roll', 'ice_thickness']:
+            a[key] = geo[key].values[xo]
     else:
-        return
+        return Skipped('missing input')
 
     if os.path.isfile(p['rsr_path'] + '/' + pst + '/' + product + '.' + pik + '.surface_coefficients'):
         b = icp.read.surface_coefficients(pst, pik, **kwargs)
@@ -200,20 +554,93 @@ def gather(pst, pik, fil=None, product='MagHiResInco1', **kwargs):
         a['Rbn'] = [np.nan for i in xo]
 
     if fil is None:
-        fil = p['season'] + '_gather.csv'
-
-    if os.path.isfile(fil):
-        c = pd.read_csv(fil)
-        d = c.append(a, ignore_index=True)
-        d.to_csv(fil, index=False, float_format='%.7f', na_rep='nan')
+        fil = p['season'] + '_gather'
+
+    target = fil + '/' + pst.replace('/', '_') + '.' + pik + '.npz'
+    icp.read.savez(a, target)
+
+
+
+GROUP_REQUIRED = ['xo', 'longitude', 'latitude', 'Pst', 'Psc', 'Psn', 'crl', 'roll'] # see group
+
+
+def group(files=None, target=None, columns=None, rem_bad=True, max_roll=2,
+          required=None, chunk=100000):
+    """Group data of many files in one tab-separated text file
+    Files are read one after the other by chunks of rows, which are
+    filtered and appended to the target. Memory is thus bounded by the
+    chunk size (or by a gathered partition), not by the whole dataset
+    ARGUMENTS
+        files : string (glob pattern of gathered partitions (npz) or of
+                tab-separated tables with a header, default: every
+                partition of <season>_gather)
+        target : string (default: <season>_group.txt)
+        columns : list (columns to keep, default: all those of the first
+                  file. Columns of the other files are matched by name,
+                  missing ones are left empty)
+        rem_bad : bool (remove rows with inf/nan required values, a roll
+                  beyond max_roll [deg] or a flag different from 1)
+        required : list (columns that must be finite, default: those of
+                   GROUP_REQUIRED in the data. Optional products, such as
+                   bed coefficients, may be nan without removing the row)
+        chunk : int (number of rows read at once)
+    OUTPUT
+        int : number of rows written
+    """
+    p = icp.get.params()
+    if files is None:
+        files = p['season'] + '_gather/*.npz'
+    if target is None:
+        target = p['season'] + '_group.txt'
+
+    n, names = 0, None
+    with icp.read.atomic(target) as f:
+        for fil in sorted(glob.glob(files)):
+            for a in _group_chunks(fil, columns, chunk):
+                if rem_bad is True:
+                    req = [i for i in (required or GROUP_REQUIRED) if i in a]
+                    a = a[np.isfinite(a[req].astype(float)).all(axis=1)]
+                    if 'roll' in a:
+                        a = a[np.abs(a.roll) < max_roll]
+                    if 'flag' in a:
+                        a = a[a.flag == 1]
+                header = names is None
+                if header: # columns of the first chunk
+                    names = list(a.columns)
+                a.reindex(columns=names).to_csv(f, sep='\t', index=False, header=header,
+                                                float_format='%.7f')
+                n = n + len(a)
+    print('CREATED: ' + target + ' (%d rows)' % n)
+    return n
+
+
+def _group_chunks(fil, columns=None, chunk=100000):
+    """Iterate over the rows of a gathered partition (npz) or of a
+    tab-separated table, by chunks
+    """
+    icp.metrics.opened(fil)
+    if fil.endswith('.npz'):
+        with np.load(fil) as a:
+            data = {key:a[key] for key in (a.files if columns is None else columns)}
+        size = len(next(iter(data.values()))) if data else 0
+        for i in range(0, size, chunk):
+            yield pd.DataFrame({key:val[i:i+chunk] for key, val in data.items()})
     else:
-        a.to_csv(fil, index=False, float_format='%.7f', na_rep='nan')
+        for a in pd.read_csv(fil, sep='\t', usecols=columns, chunksize=chunk):
+            yield a
+
+
 
+def _surface_coefficients_deps(pst, pik, **kwargs):
+    f = _product_files(pst, pik, **kwargs)
+    return f['target'] + '.surface_coefficients', [f['rsr']] + f['range']
 
 
 @loop
+@make(_surface_coefficients_deps)
 @timing
-def surface_coefficients(pst, pik, wb=15e6, gain=0, product='MagHiResInco1', save=True, **kwargs):
+def surface_coefficients(pst, pik, wb=15e6, gain=0, product='MagHiResInco1', save=True,
+                         binary=False, **kwargs):
     """Surface coefficients (Reflectance and Scattering)
     """
     p = icp.get.params()
@@ -227,14 +654,72 @@ def surface_coefficients(pst, pik, wb=15e6, gain=0, product='MagHiResInco1', sav
         if save is True:
             p = icp.get.params()
             target = p['rsr_path'] + '/' + pst + '/' + product + '.' + pik + '.' + inspect.stack()[0][3]
-            icp.do.save(out, target)
+            icp.do.save(out, target, binary=binary)
+
+
+
+def spm(frq, pc, pn, accuracy=1e-3):
+    """Small Perturbation Model inversion over arrays of pc and pn
+    Same model as rsr.invert.spm, which increases sh by steps of
+    accuracy*wavelength until the coherent/incoherent ratio is reached.
+    Here the steps are tabulated once and all the samples are solved with a
+    binary search. With the default accuracy, eps and sh match
+    rsr.invert.spm to floating-point rounding; sh is never more than one
+    step (5 mm @ 60 MHz) above the exact solution
+    ARGUMENTS
+        frq : float (radar frequency [Hz])
+        pc : array (calibrated coherent component [dB])
+        pn : array (calibrated incoherent component [dB])
+        accuracy : float (sh step in wavelength)
+    OUTPUT
+        dict : {'eps':array, 'sh':array}
+    """
+    wl = ct.c/frq
+    k = 2*ct.pi/wl
+    pc_lin = 10**(np.asarray(pc, dtype=float)/10.)
+    pn_lin = 10**(np.asarray(pn, dtype=float)/10.)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        u = pc_lin/pn_lin
+
+        sh_grid, u_grid = _spm_table(wl, accuracy)
+        i = np.searchsorted(-u_grid, -u, side='left')
+        i = np.where(np.isnan(u), 0, i) # as rsr.invert.spm, stop at first step
+        sh = sh_grid[np.minimum(i, sh_grid.size-1)]
+
+        r = -np.sqrt( pc_lin*np.exp((2*k*sh)**2) )
+        eps = (1-r)**2/(1+r)**2
+
+    return {'eps':eps, 'sh':sh}
+
+
+@functools.lru_cache(maxsize=8)
+def _spm_table(wl, accuracy):
+    """RMS heights steps and corresponding coherent/incoherent ratios for
+    do.spm, down to the underflow of the ratio
+    """
+    k = 2*ct.pi/wl
+    n = int(np.ceil(28/(2*k*wl*accuracy))) + 1 # exp(-a**2) underflows for a>27.3
+    sh = np.cumsum(np.full(n, wl*accuracy)) # same rounding as iterative steps
+    a = 2*k*sh
+    with np.errstate(under='ignore'):
+        u = np.exp(-a**2)/a**2
+    return sh, u
 
 
 
+def _surface_properties_deps(pst, pik, **kwargs):
+    f = _product_files(pst, pik, **kwargs)
+    return f['target'] + '.surface_properties', \
+           [f['rsr'], f['rsr'] + '.surface_coefficients'] + f['range']
+
+
 @loop
+@make(_surface_properties_deps)
 @timing
-def surface_properties(pst, pik, wf=60e6, product='MagHiResInco1', save=True, **kwargs):
+def surface_properties(pst, pik, wf=60e6, product='MagHiResInco1', save=True,
+                       accuracy=1e-3, binary=False, **kwargs):
     """Return surface permittivity and RMS height
+    accuracy is the RMS height resolution in wavelength (see do.spm)
     """
     a = icp.read.rsr(pst, pik, **kwargs)
     b = icp.read.surface_coefficients(pst, pik, **kwargs)
@@ -245,47 +730,56 @@ def surface_properties(pst, pik, wf=60e6, product='MagHiResInco1', save=True, **
     # Ultimately change that to take the calval from a file
     calval = np.nanmedian(-a['pc']+L+b['Rsc'])
 
-    eps, sh, flag = np.zeros(np.size(h)), np.zeros(np.size(h)), np.zeros(np.size(h))
-
-    for i, val in enumerate(h):
-        tmp = invert.spm(wf, a['pc'][i]-L[i]+calval, a['pn'][i]-L[i]+calval)
-        eps[i] = tmp['eps']
-        sh[i] = tmp['sh']
-        flag[i] = np.int(3e8/wf*0.05 > tmp['sh'])
+    tmp = spm(wf, a['pc']-L+calval, a['pn']-L+calval, accuracy=accuracy)
+    eps, sh = tmp['eps'], tmp['sh']
+    flag = (3e8/wf*0.05 > sh).astype(float)
 
     out = {'0_sh':sh, '1_eps':eps, '2_flag':flag}
 
     if save is True:
         p = icp.get.params()
         target = p['rsr_path'] + '/' + pst + '/' + product + '.' + pik + '.' + inspect.stack()[0][3]
-        icp.do.save(out, target)
+        icp.do.save(out, target, binary=binary)
+
+
+
+def _srf_pik(pst, srf_pik=None):
+    """Surface pick to use with a bed pick (None if not available)
+    """
+    foo, pik_list = icp.get.pik(pst)
+    srf_pik_list = [i for i in pik_list if 'srf' in i]
+    if srf_pik:
+        return srf_pik if srf_pik in srf_pik_list else None
+    else: # Choose first pik in the list
+        return srf_pik_list[0] if srf_pik_list else None
+
 
+def _bed_coefficients_deps(pst, pik, srf_pik=None, **kwargs):
+    b = _product_files(pst, pik, **kwargs)
+    out = [b['rsr'], b['treg']] + b['range']
+    srf_pik = _srf_pik(pst, srf_pik)
+    if srf_pik is not None:
+        s = _product_files(pst, srf_pik, **kwargs)
+        out += [s['rsr'], s['rsr'] + '.surface_properties']
+    return b['target'] + '.bed_coefficients', out
 
 
 @loop
+@make(_bed_coefficients_deps)
 @timing
-def bed_coefficients(pst, bed_pik, srf_pik=None, att_rate=0., wf=60e6, wb=15e6, product='MagHiResInco1', save=True, **kwargs):
+def bed_coefficients(pst, bed_pik, srf_pik=None, att_rate=0., wf=60e6, wb=15e6, product='MagHiResInco1', save=True,
+                     binary=False, **kwargs):
     """Return bed reflance and scattering coefficients
     att_rate is 1-way attenuation rate of the ice in dB/km
     """
     p = icp.get.params()
 
     # Get srf_pik
-    foo, pik_list = icp.get.pik(pst)
-    srf_pik_list = [i for i in pik_list if 'srf' in i]
-
-    if srf_pik:
-        if srf_pik in srf_pik_list:
-            pass
-        else:
-            print('IGNORED: No ' + srf_pik + ' for '+pst)
-            return
-    else: # Choose first pik in the list
-        if srf_pik_list:
-            srf_pik = srf_pik_list[0]
-        else:
-            print('IGNORED: No srf pik for '+pst)
-            return
+    srf_name = _srf_pik(pst, srf_pik)
+    if srf_name is None:
+        print('IGNORED: No ' + (srf_pik or 'srf pik') + ' for '+pst)
+        return
+    srf_pik = srf_name
 
     s = icp.read.rsr(pst, srf_pik, **kwargs)
     s_prop = icp.read.surface_properties(pst, srf_pik, **kwargs)
@@ -307,6 +801,6 @@ def bed_coefficients(pst, bed_pik, srf_pik=None, att_rate=0., wf=60e6, wb=15e6,
     if save is True:
         p = icp.get.params()
         target = p['rsr_path'] + '/' + pst + '/' + product + '.' + bed_pik + '.' + inspect.stack()[0][3]
-        icp.do.save(out, target)
+        icp.do.save(out, target, binary=binary)
 
 
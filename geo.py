@@ -0,0 +1,417 @@
+"""
+Spatial index of the gathered data and polar stereographic projection
+Author: Cyril Grima <cyril.grima@gmail.com>
+
+Gathered windows (see do.gather) are projected in Antarctic polar
+stereographic coordinates (EPSG:3031) and sorted by square cells of a
+grid. A query only reads the cells overlapping the region before the
+exact test, so that it does not scan the whole dataset.
+"""
+
+import functools
+import icecap as icp
+import numpy as np
+import os
+import pandas as pd
+
+
+A, E, LAT_TS = 6378137.0, 0.08181919, -71. # WGS84 ellipsoid, true-scale latitude
+
+
+def ll2ps(lat, lon, lat_ts=LAT_TS, a=A, e=E):
+    """Latitude/longitude [deg] to Antarctic polar stereographic
+    coordinates (EPSG:3031) [m]
+    """
+    lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+    phi_c = -np.deg2rad(lat_ts)
+    t_c = np.tan(np.pi/4 - phi_c/2)/((1 - e*np.sin(phi_c))/(1 + e*np.sin(phi_c)))**(e/2)
+    m_c = np.cos(phi_c)/np.sqrt(1 - e**2*np.sin(phi_c)**2)
+    phi = -np.deg2rad(lat)
+    t = np.tan(np.pi/4 - phi/2)/((1 - e*np.sin(phi))/(1 + e*np.sin(phi)))**(e/2)
+    rho = a*m_c*t/t_c
+    return rho*np.sin(np.deg2rad(lon)), rho*np.cos(np.deg2rad(lon))
+
+
+def ps2ll(x, y, lat_ts=LAT_TS, a=A, e=E):
+    """Antarctic polar stereographic coordinates (EPSG:3031) [m] to
+    latitude/longitude [deg]
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    phi_c = -np.deg2rad(lat_ts)
+    t_c = np.tan(np.pi/4 - phi_c/2)/((1 - e*np.sin(phi_c))/(1 + e*np.sin(phi_c)))**(e/2)
+    m_c = np.cos(phi_c)/np.sqrt(1 - e**2*np.sin(phi_c)**2)
+    t = np.sqrt(x**2 + y**2)*t_c/(a*m_c)
+    chi = np.pi/2 - 2*np.arctan(t)
+    phi = chi + (e**2/2 + 5*e**4/24 + e**6/12)*np.sin(2*chi) + \
+          (7*e**4/48 + 29*e**6/240)*np.sin(4*chi) + (7*e**6/120)*np.sin(6*chi)
+    return -np.rad2deg(phi), np.rad2deg(np.arctan2(x, y))
+
+
+INDEX_COLUMNS = ['pst', 'pik', 'xo', 'longitude', 'latitude']
+
+
+def index(fil=None, cell=10000., refresh=False):
+    """Spatial index of the data gathered by do.gather
+    It is saved in <fil>/.index.npz and rebuilt when a partition is added,
+    removed or newer than it
+    ARGUMENTS
+        fil : string (partition folder, default: <season>_gather)
+        cell : float (size of the grid cells [m])
+        refresh : bool (rebuild the index anyway)
+    OUTPUT
+        dict : arrays of the indexed windows (pst, pik, xo, longitude,
+               latitude, x, y) sorted by cell, with the grid definition
+    """
+    if fil is None:
+        fil = icp.get.params()['season'] + '_gather'
+    target = fil + '/.index.npz'
+    if not os.path.isdir(fil):
+        raise ValueError('No gathered data in ' + fil + ', run do.gather first')
+    partitions = sorted(i.name for i in os.scandir(fil) if i.name.endswith('.npz')
+                        and not i.name.startswith('.'))
+
+    if refresh is False and os.path.isfile(target):
+        out = _index(target, os.path.getmtime(target))
+        t = os.path.getmtime(target)
+        if out['cell'] == cell and list(out['partitions']) == partitions and \
+           all(os.path.getmtime(fil + '/' + i) <= t for i in partitions):
+            return out
+
+    a = icp.read.gather(fil=fil, columns=INDEX_COLUMNS)
+    a = a.astype({'longitude':float, 'latitude':float}) # object if empty
+    a = a[np.isfinite(a.longitude) & np.isfinite(a.latitude)]
+    x, y = ll2ps(a.latitude, a.longitude)
+    x0 = np.floor(x.min()/cell)*cell if x.size else 0.
+    y0 = np.floor(y.min()/cell)*cell if y.size else 0.
+    ix, iy = ((x - x0)//cell).astype(np.int64), ((y - y0)//cell).astype(np.int64)
+    nx, ny = (ix.max() + 1, iy.max() + 1) if x.size else (0, 0)
+    key = ix*ny + iy
+    order = np.argsort(key, kind='stable')
+
+    out = {key_i:np.asarray(a[key_i])[order] for key_i in INDEX_COLUMNS}
+    out.update({'x':x[order], 'y':y[order], 'key':key[order], 'x0':x0, 'y0':y0,
+                'nx':nx, 'ny':ny, 'cell':cell, 'partitions':np.array(partitions, dtype=str)})
+    icp.read.savez(out, target)
+    return _index(target, os.path.getmtime(target))
+
+
+@functools.lru_cache(maxsize=4)
+def _index(fil, mtime):
+    """Cached spatial index file
+    """
+    icp.metrics.opened(fil)
+    with np.load(fil) as a:
+        out = {key:a[key] for key in a.files}
+    for key in ['x0', 'y0', 'nx', 'ny', 'cell']:
+        out[key] = out[key].item()
+    return out
+
+
+def bbox(lat, lon, idx=None):
+    """Indexed windows within latitude and longitude bounds
+    ARGUMENTS
+        lat : (float, float) (latitude bounds [deg])
+        lon : (float, float) (longitude bounds [deg], crossing 180 deg if
+              the first is larger than the second)
+        idx : dict (spatial index, default: index())
+    OUTPUT
+        DataFrame : pst, pik, xo, longitude, latitude of the windows
+    """
+    idx = index() if idx is None else idx
+    lon0, lon1 = lon
+    lon1 = lon1 + 360 if lon1 < lon0 else lon1
+    # Meridians are straight lines, the extent is the one of the parallels
+    blon = np.linspace(lon0, lon1, 3601)
+    x, y = ll2ps(np.concatenate([lat[0] + 0*blon, lat[1] + 0*blon]), np.tile(blon, 2))
+    w = _cells(idx, x.min(), x.max(), y.min(), y.max())
+    la, lo = idx['latitude'][w], idx['longitude'][w]
+    ok = (la >= lat[0]) & (la <= lat[1]) & ((lo - lon0) % 360 <= lon1 - lon0)
+    return _hits(idx, w[ok])
+
+
+def radius(lat, lon, r, idx=None):
+    """Indexed windows within a distance of a point
+    ARGUMENTS
+        lat, lon : float (center [deg])
+        r : float (distance in the polar stereographic plane [m])
+        idx : dict (spatial index, default: index())
+    OUTPUT
+        DataFrame : pst, pik, xo, longitude, latitude of the windows
+    """
+    idx = index() if idx is None else idx
+    x, y = ll2ps(lat, lon)
+    w = _cells(idx, x-r, x+r, y-r, y+r)
+    ok = (idx['x'][w] - x)**2 + (idx['y'][w] - y)**2 <= r**2
+    return _hits(idx, w[ok])
+
+
+def polygon(lat, lon, idx=None):
+    """Indexed windows inside a polygon
+    ARGUMENTS
+        lat, lon : array (vertices [deg], joined by straight lines in the
+                   polar stereographic plane)
+        idx : dict (spatial index, default: index())
+    OUTPUT
+        DataFrame : pst, pik, xo, longitude, latitude of the windows
+    """
+    idx = index() if idx is None else idx
+    x, y = ll2ps(lat, lon)
+    w = _cells(idx, x.min(), x.max(), y.min(), y.max())
+    ok = inside(idx['x'][w], idx['y'][w], x, y)
+    return _hits(idx, w[ok])
+
+
+def query(region, idx=None):
+    """Indexed windows in a region
+    ARGUMENTS
+        region : dict ({'bbox':(lat, lon)}, {'radius':(lat, lon, r)} or
+                 {'polygon':(lat, lon)}, with the arguments of bbox, radius
+                 or polygon)
+        idx : dict (spatial index, default: index())
+    OUTPUT
+        DataFrame : pst, pik, xo, longitude, latitude of the windows
+    """
+    (kind, args), = region.items()
+    return {'bbox':bbox, 'radius':radius, 'polygon':polygon}[kind](*args, idx=idx)
+
+
+def within(region, lat, lon):
+    """Whether points are in a region (see query)
+    """
+    (kind, args), = region.items()
+    lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+    if kind == 'bbox':
+        (lat0, lat1), (lon0, lon1) = args
+        lon1 = lon1 + 360 if lon1 < lon0 else lon1
+        return (lat >= lat0) & (lat <= lat1) & ((lon - lon0) % 360 <= lon1 - lon0)
+    x, y = ll2ps(lat, lon)
+    if kind == 'radius':
+        xc, yc = ll2ps(args[0], args[1])
+        return (x - xc)**2 + (y - yc)**2 <= args[2]**2
+    if kind == 'polygon':
+        return inside(x, y, *ll2ps(args[0], args[1]))
+    raise ValueError('Unknown region ' + repr(kind))
+
+
+def frames(region, pattern='*', pik=None, margin=1000, idx=None):
+    """1-m frames of each PST in a region
+    The PSTs crossing the region are found with the spatial index (see
+    index), and only their frames within margin of the hit windows are
+    tested. A region narrower than the spacing of the gathered windows
+    may be missed
+    ARGUMENTS
+        region : dict (see query)
+        pattern : string (PSTs to consider, e.g. 'MIS/JKB2e/*')
+        pik : string (only the PSTs gathered with this pick)
+        margin : int (frames around the hit windows)
+        idx : dict (spatial index, default: index())
+    OUTPUT
+        dict : {pst:frames}
+    """
+    hits = query(region, idx=idx)
+    if pik is not None:
+        hits = hits[hits.pik == pik]
+    out = {}
+    for pst in sorted(pd.unique(hits.pst)):
+        if pst not in icp.get.pst(pattern):
+            continue
+        g = icp.get.geo(pst)
+        xo = hits.xo[hits.pst == pst].astype(int)
+        f = np.arange(max(xo.min() - margin, 0), min(xo.max() + margin + 1, len(g)))
+        f = f[within(region, g.latitude.values[f], g.longitude.values[f])]
+        if f.size:
+            out[pst] = f
+    return out
+
+
+def inside(x, y, px, py):
+    """Whether points are inside a polygon (even-odd rule)
+    ARGUMENTS
+        x, y : array (points)
+        px, py : array (vertices of the polygon)
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    out = np.zeros(x.shape, dtype=bool)
+    for xa, ya, xb, yb in zip(px, py, np.roll(px, -1), np.roll(py, -1)):
+        cross = (ya > y) != (yb > y)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            xc = xa + (y - ya)*(xb - xa)/(yb - ya)
+        out ^= cross & (x < xc)
+    return out
+
+
+def _cells(idx, xmin, xmax, ymin, ymax):
+    """Positions in the index of the windows in the cells overlapping a
+    rectangle of the polar stereographic plane
+    """
+    c, nx, ny = idx['cell'], idx['nx'], idx['ny']
+    ix = np.arange(max(int((xmin - idx['x0'])//c), 0), min(int((xmax - idx['x0'])//c), nx-1) + 1)
+    iy0 = max(int((ymin - idx['y0'])//c), 0)
+    iy1 = min(int((ymax - idx['y0'])//c), ny-1)
+    if ix.size == 0 or iy0 > iy1:
+        return np.array([], dtype=int)
+    start = np.searchsorted(idx['key'], ix*ny + iy0, side='left')
+    stop = np.searchsorted(idx['key'], ix*ny + iy1, side='right')
+    return np.concatenate([np.arange(i, j) for i, j in zip(start, stop)])
+
+
+def _hits(idx, w):
+    """Windows of the index at positions w
+    """
+    return pd.DataFrame({key:idx[key][w] for key in INDEX_COLUMNS})
+
+
+def simplify(x, y, tolerance):
+    """Simplify a line with the Douglas-Peucker algorithm
+    ARGUMENTS
+        x, y : array (points of the line)
+        tolerance : float (maximum distance of the removed points to the
+                    simplified line)
+    OUTPUT
+        array : positions of the points kept
+    """
+    keep = np.zeros(x.size, dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, x.size-1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        dx, dy = x[j] - x[i], y[j] - y[i]
+        length = np.hypot(dx, dy)
+        if length > 0:
+            d = np.abs(dy*(x[i+1:j] - x[i]) - dx*(y[i+1:j] - y[i]))/length
+        else:
+            d = np.hypot(x[i+1:j] - x[i], y[i+1:j] - y[i])
+        k = np.argmax(d)
+        if d[k] > tolerance:
+            k += i + 1
+            keep[k] = True
+            stack += [(i, k), (k, j)]
+    return np.flatnonzero(keep)
+
+
+def crossovers(pattern='*', pik=None, columns=['Psc', 'Rsc', 'eps', 'sh'],
+               fil=None, tolerance=50., cell=10000.):
+    """Crossovers between the ground tracks of PSTs
+    Tracks (see get.geo) are simplified (see simplify) and their segments
+    sorted by grid cells, so that only the segments sharing a cell are
+    tested. Each crossing is then located on the 1-m frames of both PSTs
+    ARGUMENTS
+        pattern : string (PSTs, e.g. 'MIS/JKB2e/*')
+        pik : string (pick of the gathered data to compare, default: none)
+        columns : list (gathered data to compare, see do.gather)
+        fil : string (partition folder, default: <season>_gather)
+        tolerance : float (track simplification [m])
+        cell : float (size of the grid cells [m])
+    OUTPUT
+        DataFrame : for each crossover, PST and closest frame on each track
+                    (pst_1, frame_1, pst_2, frame_2), position, and if pik
+                    is given the closest gathered window on each track
+                    (xo_1, xo_2) with the values of columns (<column>_1,
+                    <column>_2) and their difference (d_<column>)
+    """
+    psts = icp.get.pst(pattern)
+    seg = {'i':[], 'x0':[], 'y0':[], 'x1':[], 'y1':[], 'f0':[], 'f1':[]}
+    for i, pst in enumerate(psts):
+        g = icp.get.geo(pst)
+        if g is None:
+            continue
+        frame = np.flatnonzero(np.isfinite(g.longitude) & np.isfinite(g.latitude))
+        if frame.size < 2:
+            continue
+        x, y = ll2ps(g.latitude.values[frame], g.longitude.values[frame])
+        k = simplify(x, y, tolerance)
+        for key, val in zip(seg, [np.full(k.size-1, i), x[k[:-1]], y[k[:-1]], x[k[1:]],
+                                  y[k[1:]], frame[k[:-1]], frame[k[1:]]]):
+            seg[key].append(val)
+    out = pd.DataFrame(columns=['pst_1', 'frame_1', 'pst_2', 'frame_2',
+                                'longitude', 'latitude'])
+    if not seg['i']:
+        return out
+    seg = {key:np.concatenate(val) for key, val in seg.items()}
+
+    # Segments by cell
+    ix0 = (np.minimum(seg['x0'], seg['x1'])//cell).astype(np.int64)
+    ix1 = (np.maximum(seg['x0'], seg['x1'])//cell).astype(np.int64)
+    iy0 = (np.minimum(seg['y0'], seg['y1'])//cell).astype(np.int64)
+    iy1 = (np.maximum(seg['y0'], seg['y1'])//cell).astype(np.int64)
+    nx, ny = ix1 - ix0 + 1, iy1 - iy0 + 1
+    s = np.repeat(np.arange(nx.size), nx*ny)
+    j = np.arange(s.size) - np.repeat(np.cumsum(nx*ny) - nx*ny, nx*ny)
+    cx, cy = ix0[s] + j//ny[s], iy0[s] + j%ny[s]
+    order = np.lexsort([s, cy, cx])
+    s, cx, cy = s[order], cx[order], cy[order]
+    bounds = np.flatnonzero(np.diff(cx) | np.diff(cy)) + 1
+
+    # Candidate pairs of segments of different PSTs
+    pairs = []
+    for group in np.split(s, bounds):
+        if group.size > 1 and np.any(seg['i'][group] != seg['i'][group[0]]):
+            a, b = np.triu_indices(group.size, 1)
+            pairs.append(np.column_stack([group[a], group[b]]))
+    if not pairs:
+        return out
+    pairs = np.unique(np.concatenate(pairs), axis=0)
+    a, b = pairs[seg['i'][pairs[:, 0]] != seg['i'][pairs[:, 1]]].T
+
+    # Intersection of the segments
+    dxa, dya = seg['x1'][a] - seg['x0'][a], seg['y1'][a] - seg['y0'][a]
+    dxb, dyb = seg['x1'][b] - seg['x0'][b], seg['y1'][b] - seg['y0'][b]
+    ex, ey = seg['x0'][b] - seg['x0'][a], seg['y0'][b] - seg['y0'][a]
+    den = dxa*dyb - dya*dxb
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t, u = (ex*dyb - ey*dxb)/den, (ex*dya - ey*dxa)/den
+    ok = (den != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    a, b, t = a[ok], b[ok], t[ok]
+    x, y = seg['x0'][a] + t*dxa[ok], seg['y0'][a] + t*dya[ok]
+
+    # Closest 1-m frames to the crossing on both tracks
+    frame_1, frame_2 = _closest(psts, seg, a, x, y), _closest(psts, seg, b, x, y)
+    lat, lon = ps2ll(x, y)
+    out = pd.DataFrame({'pst_1':np.array(psts)[seg['i'][a]], 'frame_1':frame_1,
+                        'pst_2':np.array(psts)[seg['i'][b]], 'frame_2':frame_2,
+                        'longitude':lon, 'latitude':lat})
+    # A crossing at a vertex is found on the two segments sharing it
+    out = out.drop_duplicates(['pst_1', 'frame_1', 'pst_2', 'frame_2'], ignore_index=True)
+
+    if pik is not None:
+        for k in ['1', '2']:
+            w = _closest_window(out['pst_' + k], out['frame_' + k], pik, columns, fil)
+            for key, val in w.items():
+                out[key + '_' + k] = val
+        for key in columns:
+            out['d_' + key] = out[key + '_1'] - out[key + '_2']
+    return out
+
+
+def _closest(psts, seg, s, x, y):
+    """Closest 1-m frame to (x, y) on the track of each segment s
+    """
+    out = np.zeros(s.size, dtype=int)
+    for i in np.unique(seg['i'][s]):
+        g = icp.get.geo(psts[i])
+        for k in np.flatnonzero(seg['i'][s] == i):
+            f = np.arange(seg['f0'][s[k]], seg['f1'][s[k]] + 1)
+            xf, yf = ll2ps(g.latitude.values[f], g.longitude.values[f])
+            out[k] = f[np.nanargmin(np.hypot(xf - x[k], yf - y[k]))]
+    return out
+
+
+def _closest_window(pst, frame, pik, columns, fil=None):
+    """Gathered window (see do.gather) closest to a frame of a PST
+    """
+    out = {key:np.full(len(pst), np.nan) for key in ['xo'] + columns}
+    for i in pd.unique(pst):
+        a = icp.read.gather(fil=fil, columns=['xo'] + columns,
+                            pattern=i.replace('/', '_') + '.' + pik)
+        if a.empty:
+            continue
+        k = np.flatnonzero(np.asarray(pst) == i)
+        f = np.asarray(frame)[k]
+        xo = a.xo.values.astype(float)
+        j = np.clip(np.searchsorted(xo, f), 1, max(xo.size-1, 1))
+        j = np.where(np.abs(xo[j-1] - f) <= np.abs(xo[np.minimum(j, xo.size-1)] - f), j-1, j)
+        for key in out:
+            out[key][k] = a[key].values[j]
+    return out
@@ -1,11 +1,18 @@
+import functools
 import glob
 import icecap as icp
+import icecap.metrics
+import json
 import numpy as np
 import os
 import fnmatch
 import subradar as sr
 import rsr
 import pandas as pd
+import re
+
+
+DAY_ZTIM = 864000000 # ztim in a day [1e-4 s]
 
 
 def params():
@@ -27,14 +34,15 @@ def params():
     return out
 
 
-def pik(pst, process=None, **kwargs):
+def pik(pst, process=None, inventory=False, **kwargs):
     """Get available PIK files for a PST
+    inventory=True answers from the season inventory (see get.inventory)
     """
     p = icp.get.params()
     if process is None:
         process = p['process']
     folder = '/'.join([p['pik_path'].replace('/'+p['process'],''), process, pst])
-    files = glob.glob(folder + '/*.*')
+    files = _glob(folder, '*.*', inventory)
     names = [i.split('/')[-1] for i in files]
     products = [i.split('.')[0] for i in names]
     pik = [i.split('.')[1] for i in names]
@@ -42,61 +50,198 @@ def pik(pst, process=None, **kwargs):
     return products, pik
 
 
-def cmp(pst, process=None, **kwargs):
+def cmp(pst, process=None, inventory=False, **kwargs):
     """Get available radar data in CMP for a PST
+    inventory=True answers from the season inventory (see get.inventory)
     """
     p = icp.get.params()
     if process is None:
         process = p['process']
     folder = '/'.join([p['cmp_path'].replace('/'+p['process'],''), process, pst])
-    files = glob.glob(folder + '/*[!.meta]')
+    files = _glob(folder, '*[!.meta]', inventory)
     products = [i.split('/')[-1] for i in files]
     return products
 
 
-def pst(pattern, **kwargs):
-    """Get PSTs for the current season that match a given pattern (regex)
+def pst(pattern, regex=False, **kwargs):
+    """Get PSTs for the current season that match a given pattern
+    ARGUMENTS
+        pattern : string (glob pattern, e.g. 'MIS/JKB2e/*')
+        regex : bool (True if pattern is a regular expression)
     """
     p = icp.get.params()
-    data = np.genfromtxt(p['season_flight_pst'], delimiter=' ', dtype=np.str)
-    i = np.where(data[:,2] == p['season'])
-    pst = data[i,0]
-    return fnmatch.filter(pst.flatten(), pattern)
+    db = season_db(p['season_flight_pst'])
+    if regex is False and not any(i in pattern for i in '*?['):
+        return [pattern] if db['season_of'].get(pattern) == p['season'] else []
+    pst = db['season'].get(p['season'], ())
+    if regex is True:
+        match = re.compile(pattern).fullmatch
+        return [i for i in pst if match(i)]
+    return fnmatch.filter(pst, pattern)
+
+
+def season_db(fil=None):
+    """Indexed season_flight_pst database
+    Parsed once per process and reloaded when the file is modified
+    OUTPUT
+        dict : {'flight':{pst:flight}, 'season_of':{pst:season},
+                'season':{season:(pst, ...)}}
+    """
+    if fil is None:
+        fil = icp.get.params()['season_flight_pst']
+    return _season_db(fil, os.path.getmtime(fil))
+
+
+@functools.lru_cache(maxsize=4)
+def _season_db(fil, mtime):
+    """Cached season_flight_pst database
+    """
+    out = {'flight':{}, 'season_of':{}, 'season':{}}
+    with open(fil) as f:
+        for line in f:
+            a = line.split()
+            if len(a) < 3:
+                continue
+            out['flight'][a[0]] = a[1]
+            out['season_of'][a[0]] = a[2]
+            out['season'].setdefault(a[2], []).append(a[0])
+    out['season'] = {key:tuple(val) for key, val in out['season'].items()}
+    return out
 
 
-def sweep(pst, **kwargs):
+def sweep(pst, inventory=False, **kwargs):
     """Get available sweeps files for a PST
+    inventory=True answers from the season inventory (see get.inventory)
     """
     p = icp.get.params()
     folder = '/'.join([p['sweep_path'], pst])
-    files = glob.glob(folder + '/*sweeps*')
+    files = _glob(folder, '*sweeps*', inventory)
     products = [i.split('/')[-1] for i in files]
     return products
 
 
-def rsr(pst, process=None, **kwargs):
+def rsr(pst, process=None, inventory=False, **kwargs):
     """Get available rsr files
+    inventory=True answers from the season inventory (see get.inventory)
     """
     p = icp.get.params()
     if process is None:
         process = p['process']
     folder = '/'.join([p['rsr_path'].replace('/'+p['process'],''), process, pst])
-    files = glob.glob(folder + '/*.*')
+    files = _glob(folder, '*.*', inventory)
     products = [i.split('/')[-1] for i in files]
     pik = [i.split('.')[1] for i in products if len(i.split('.')) == 2]
     return pik
 
 
-def rsr_data(pst, **kwargs):
+def inventory(refresh=False, fil=None):
+    """Inventory of the PIK, CMP, RSR and sweep folders of the season
+    Built by one recursive scan and saved in fil (default:
+    <season>_inventory.json, out of the scanned folders) or, if it cannot
+    be written, kept in memory. refresh=True rescans the folders, only
+    listing again those whose modification time changed. Without refresh,
+    get.pik, get.cmp, get.rsr and get.sweep still list again a folder
+    modified since the inventory
+    OUTPUT
+        dict : {folder:{'mtime':float, 'names':[...], 'dirs':[...]}}
+    """
+    p = icp.get.params()
+    if fil is None:
+        fil = p['season'] + '_inventory.json'
+    if fil in _INVENTORY:
+        old = _INVENTORY[fil]
+    elif os.path.isfile(fil):
+        old = _inventory(fil, os.path.getmtime(fil))
+    else:
+        old = {}
+    if refresh is False and old:
+        return old
+
+    out = {}
+    for root in _inventory_roots(p):
+        _scan(root, old, out)
+    if out != old:
+        try:
+            with icp.read.atomic(fil) as f:
+                json.dump(out, f)
+            _INVENTORY.pop(fil, None)
+        except OSError: # read-only folder
+            print('IGNORED: cannot save ' + fil)
+            _INVENTORY[fil] = out
+    return out
+
+
+_INVENTORY = {} # inventories that could not be saved, by file (see inventory)
+
+
+def _inventory_roots(p):
+    """Folders covered by the inventory
+    """
+    return [p['pik_path'].replace('/'+p['process'], ''),
+            p['cmp_path'].replace('/'+p['process'], ''),
+            p['rsr_path'].replace('/'+p['process'], ''), p['sweep_path']]
+
+
+def _scan(folder, old, out):
+    """Recursively list a folder into out, reusing the listing in old of
+    the folders that have not been modified
+    """
+    try:
+        mtime = os.stat(folder).st_mtime
+    except OSError:
+        return
+    if folder in old and old[folder]['mtime'] == mtime:
+        out[folder] = old[folder]
+    else:
+        names, dirs = [], []
+        with os.scandir(folder) as it:
+            for i in it:
+                names.append(i.name)
+                if i.is_dir():
+                    dirs.append(i.name)
+        out[folder] = {'mtime':mtime, 'names':sorted(names), 'dirs':sorted(dirs)}
+    for i in out[folder]['dirs']:
+        _scan(folder + '/' + i, old, out)
+
+
+@functools.lru_cache(maxsize=4)
+def _inventory(fil, mtime):
+    """Cached inventory file
+    """
+    with open(fil) as f:
+        return json.load(f)
+
+
+def _glob(folder, pattern, inventory=False):
+    """Files of a folder matching a glob pattern, from the file system or
+    from the season inventory. Folders out of the inventory, or modified
+    since it was saved, are globbed
+    """
+    if inventory is True:
+        inv = icp.get.inventory()
+        try:
+            mtime = os.stat(folder).st_mtime
+        except OSError: # missing folder
+            return []
+        if folder in inv and inv[folder]['mtime'] == mtime:
+            return [folder + '/' + i for i in fnmatch.filter(inv[folder]['names'], pattern)
+                    if not i.startswith('.')]
+    return glob.glob(folder + '/' + pattern)
+
+
+def rsr_data(pst, inventory=True, **kwargs):
     """Display data avaialble to launch RSR
+    inventory=True refreshes the season inventory once and answers from it
     """
+    if inventory is True:
+        icp.get.inventory(refresh=True)
     psts = icp.get.pst(pst)
-    cmps = [ icp.get.cmp(i, process='pik1') for i in psts ]
-    cmps_1m = [ icp.get.cmp(i, process='pik1.1m') for i in psts ]
-    piks = [ icp.get.pik(i, process='pik1')[1] for i in psts]
-    piks_1m = [ icp.get.pik(i, process='pik1.1m')[1] for i in psts]
-    sweeps = [ icp.get.sweep(i) for i in psts ]
-    rsr_1m = [ icp.get.rsr(i, process='pik1.1m') for i in psts  ]
+    cmps = [ icp.get.cmp(i, process='pik1', inventory=inventory) for i in psts ]
+    cmps_1m = [ icp.get.cmp(i, process='pik1.1m', inventory=inventory) for i in psts ]
+    piks = [ icp.get.pik(i, process='pik1', inventory=inventory)[1] for i in psts]
+    piks_1m = [ icp.get.pik(i, process='pik1.1m', inventory=inventory)[1] for i in psts]
+    sweeps = [ icp.get.sweep(i, inventory=inventory) for i in psts ]
+    rsr_1m = [ icp.get.rsr(i, process='pik1.1m', inventory=inventory) for i in psts  ]
     d = {'PST':psts}
     df = pd.DataFrame(d)
     #df['CMP_pik1'] = cmps
@@ -114,10 +259,7 @@ def rsr_data(pst, **kwargs):
 def flight(pst):
     """Get Flight for a PST
     """
-    p = icp.get.params()
-    data = np.genfromtxt(p['season_flight_pst'], delimiter=' ', dtype=np.str)
-    i = np.where(data[:,0] == pst)
-    return data[i,:].flatten()[1]
+    return season_db()['flight'][pst]
 
 
 def surface_range(pst, **kwargs):
@@ -129,8 +271,7 @@ def surface_range(pst, **kwargs):
 
 
 def ice_thickness(pst, **kwargs):
-    p = icp.get.params()
-    tref = icp.read.ztim(p['foc_path']+'/'+pst+'/ztim_DNhH')['htim']
+    tref = icp.read.timebase(pst)
     try:
         t, val = icp.read.targ(pst, 'treg', 'TRJ_JKB0', 'ztim_llzrphsaaa', interp=True)
     except TypeError:
@@ -158,22 +299,111 @@ column=-7)
         t, val = icp.read.norm(pst, 'AVN', 'roll_ang', interp=True)
     return val
 
-def signal(pst, pik, scale=1/1000., calib=True, air_loss=True, gain=0, **kwargs):
+
+@icp.metrics.stage
+def geo(pst, cache=True, **kwargs):
+    """Geographic streams of a PST interpolated along the FOC time
+    All the streams are read in a single pass on the same timebase and
+    returned in one DataFrame (htim, longitude, latitude, surface_range,
+    roll, ice_thickness; nans for missing streams). The result is cached in
+    <rsr_path>/<pst>/.geo.npz, when writable, and recomputed when a source
+    file is newer
+    """
+    p = icp.get.params()
+    target = p['rsr_path'] + '/' + pst + '/.geo.npz'
+    sources = _geo_sources(pst, p)
+
+    if cache is True and os.path.isfile(target):
+        t = os.path.getmtime(target)
+        if all(os.path.getmtime(i) <= t for i in sources if os.path.isfile(i)):
+            icp.metrics.opened(target)
+            with np.load(target) as a:
+                return pd.DataFrame({key:a[key] for key in a.files})
+
+    tref = icp.read.timebase(pst)
+    if tref is None: return
+    nan = np.full(tref.size, np.nan)
+    out = {'htim':tref}
+
+    gps = icp.read.norm(pst, 'GPS', ['lon_ang', 'lat_ang'], interp=True)
+    out['longitude'], out['latitude'] = gps[1].T if gps else (nan, nan)
+
+    las = icp.read.norm(pst, 'LAS', 'las_rng', interp=True)
+    out['surface_range'] = las[1] if las else nan
+
+    trj = icp.read.targ(pst, 'treg', 'TRJ_JKB0', 'ztim_llzrphsaaa', interp=True,
+                        column=[-7, -1])
+    if _roll_from_treg(pst):
+        out['roll'] = trj[1][:, 0] if trj else nan
+    else:
+        avn = icp.read.norm(pst, 'AVN', 'roll_ang', interp=True)
+        out['roll'] = avn[1] if avn else nan
+    out['ice_thickness'] = trj[1][:, 1] if trj else nan
+
+    out = pd.DataFrame(out)
+    icp.metrics.frames(len(out))
+    if cache is True:
+        try:
+            icp.read.savez(out, target)
+        except OSError: # read-only product tree
+            print('IGNORED: cannot cache ' + target)
+    return out
+
+
+def _roll_from_treg(pst):
+    """Whether the roll of a PST is taken from treg rather than from norm
+    """
+    return pst.split('/')[1] in ['JKB2t'] and \
+           pst.split('/')[0] in ['SRH1', 'DEV', 'DEV2', 'HIC', 'NDEVON']
+
+
+def _geo_sources(pst, p):
+    """Files read by get.geo
+    """
+    norm = p['norm_path'] + '/' + pst + '/'
+    ac = pst.split('/')[1][0:3] + 'a/'
+    out = [p['foc_path'] + '/' + pst + '/ztim_DNhH',
+           p['treg_path'] + '/' + pst + '/TRJ_JKB0/ztim_llzrphsaaa.bin']
+    for instrument, streams in [('GPS', ['lon_ang', 'lat_ang']), ('LAS', ['las_rng']),
+                                ('AVN', ['roll_ang'])]:
+        out += [norm + instrument + '_' + ac + i for i in streams + ['syn_ztim']]
+    return out
+
+
+@icp.metrics.stage
+def signal(pst, pik, scale=1/1000., calib=True, air_loss=True, gain=0,
+           from_cmp=False, window=0, frame=None, **kwargs):
     """Extract signal from a pik file and apply various corrections
+    from_cmp=True re-extracts the echo power from the CMP radargram along
+    the pick samples, at the maximum within +/- window samples (see
+    read.echo) instead of using the values of the pik file.
+    frame selects the frames to return (default: all). Only these frames
+    are then read in the radargram, and the surface range is taken from
+    get.geo (cached) instead of being interpolated again. The pick file is
+    still parsed whole, but once per process (see read.pik)
     """
-    y, val = icp.read.pik(pst, pik, **kwargs)
+    if frame is None:
+        h = icp.get.surface_range(pst)
+    else:
+        h = icp.get.geo(pst)['surface_range'].values
+    if from_cmp is True:
+        a = icp.read.pik(pst, pik, all_columns=True, **kwargs)
+        y, val = a[:, 2], a[:, 1] # pick samples, replaced by the echo below
+    else:
+        y, val = icp.read.pik(pst, pik, **kwargs)
 
-    h = icp.get.surface_range(pst)
     # Pad the end of piks with nans to equal regular data length
-    padding = np.abs((0,np.size(h)-np.size(val)))
-    if len(h) > len(val):
-        val = np.pad(val.astype(float), padding, 'constant', constant_values=np.nan)
-    elif len(h) < len(val):
-        h = np.pad(h.astype(float), padding, 'constant', constant_values=np.nan)
-    else:
-        pass
+    n = max(len(h), len(val))
+    pad = lambda x: np.pad(np.asarray(x, dtype=float), (0, n-len(x)), 'constant',
+                           constant_values=np.nan)
+    y, val, h = pad(y), pad(val), pad(h)
+    if frame is not None:
+        y, val, h = y[frame], val[frame], h[frame]
+    if from_cmp is True:
+        val = icp.read.echo(icp.read.cmp(pst, **kwargs), y, val, window=window)[1]
     print(scale)
     val = val*scale
+    icp.metrics.frames(len(val))
 
     if calib is True:
         calval = 0.
@@ -186,17 +416,63 @@ def signal(pst, pik, scale=1/1000., calib=True, air_loss=True, gain=0, **kwargs)
     return val + gain
 
 
-def ztim2frame(pst, year, day, ztim):
+def ztim2frame(pst, year, day, ztim, method='after'):
     """Convert ztim to the closest frame numbr in a PST
+    The FOC ztim of the PST is read once and indexed by time, so that
+    arrays of times are converted with a binary search
+    ARGUMENTS
+        pst : string (e.g. 'MIS/JKB2e/Y35a')
+        year, day, ztim : int or array (time to convert)
+        method : string ('after' for the first frame of the same day after
+                 ztim, 'nearest', 'floor' for the last frame at or before
+                 ztim or 'ceil' for the first frame at or after ztim)
+    OUTPUT
+        frame : int or array (-1 where there is no such frame)
     """
     p = icp.get.params()
-    z = icp.read.ztim(p['foc_path']+'/'+pst+'/ztim_DNhH')
-    z_year  = z[1]
-    z_day = z[3]
-    z_ztim = z[5]
-    w = [(z_year == year) * (z_day == day) * (z_ztim > ztim)]
-    frame = np.nonzero(w)[1][0]
-    return frame
+    fil = p['foc_path']+'/'+pst+'/ztim_DNhH'
+    key, order = _ztim_index(fil, os.path.getmtime(fil))
+    q = _ztim_key(year, day, ztim)
+
+    if method == 'after':
+        i = np.searchsorted(key, q, side='right')
+    elif method in ['ceil', 'nearest']:
+        i = np.searchsorted(key, q, side='left')
+    elif method == 'floor':
+        i = np.searchsorted(key, q, side='right') - 1
+    else:
+        raise ValueError('Unknown method ' + repr(method))
+    if method == 'nearest': # closest of the two bracketing frames
+        before = np.clip(i-1, 0, key.size-1)
+        after = np.clip(i, 0, key.size-1)
+        i = np.where(np.abs(q - key[before]) <= np.abs(key[after] - q), before, after)
+
+    ok = (i >= 0) & (i < key.size)
+    frame = np.where(ok, order[np.clip(i, 0, key.size-1)], -1)
+    if method == 'after': # same day only
+        same_day = key[np.clip(i, 0, key.size-1)]//DAY_ZTIM == q//DAY_ZTIM
+        frame = np.where(ok & same_day, frame, -1)
+    return frame if np.ndim(frame) else int(frame)
+
+
+def _ztim_key(year, day, ztim):
+    """Sortable time from year, day and ztim
+    """
+    return (np.asarray(year, dtype=np.int64)*1000 + np.asarray(day, dtype=np.int64))*DAY_ZTIM + \
+           np.asarray(ztim, dtype=np.int64)
+
+
+@functools.lru_cache(maxsize=16)
+def _ztim_index(fil, mtime):
+    """Cached time index of a ztim file: sorted times and the frames they
+    belong to
+    """
+    z = icp.read.ztim(fil)
+    key = _ztim_key(z[1], z[3], z[5])
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+    key.flags.writeable = order.flags.writeable = False
+    return key, order
 
 
 #def surface_coefficients(pst, pik, wb=15e6, **kwargs):
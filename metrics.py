@@ -0,0 +1,107 @@
+"""
+Timing and I/O metrics of the processing stages
+Author: Cyril Grima <cyril.grima@gmail.com>
+
+Metrics are disabled by default and cost a single test per call. Once
+enabled (metrics.enable or the ICECAP_METRICS environment variable, which
+also holds the log file name), every function decorated by metrics.stage
+appends one JSON line to the log with its wall time, CPU time, files
+opened, bytes read and frames processed, tagged with PST and pick.
+"""
+
+import functools
+import inspect
+import json
+import os
+import pandas as pd
+import time
+
+
+enabled = 'ICECAP_METRICS' in os.environ
+log = os.environ.get('ICECAP_METRICS') or 'icecap_metrics.jsonl'
+_stack = [] # counters of the stages being processed
+
+
+def enable(fil='icecap_metrics.jsonl'):
+    """Start recording metrics in a JSON-lines file (also in the worker
+    processes started afterwards)
+    """
+    global enabled, log
+    enabled, log = True, os.path.abspath(fil)
+    os.environ['ICECAP_METRICS'] = log
+
+
+def disable():
+    """Stop recording metrics
+    """
+    global enabled
+    enabled = False
+    os.environ.pop('ICECAP_METRICS', None)
+
+
+def stage(func):
+    """Decorator recording the metrics of a function
+    """
+    name = func.__module__.split('.')[-1] + '.' + func.__name__
+    sig = inspect.signature(func)
+
+    @functools.wraps(func)
+    def func_wrapper(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        counters = {'files':0, 'bytes':0, 'frames':0}
+        _stack.append(counters)
+        t1, c1 = time.time(), time.process_time()
+        error = ''
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            record = {'stage':name, 'pid':os.getpid(), 'start':t1,
+                      'wall':time.time() - t1, 'cpu':time.process_time() - c1,
+                      **_tags(sig, args, kwargs), **counters, 'error':error}
+            _stack.pop()
+            if _stack: # I/O of a nested stage is also the I/O of its parent
+                _stack[-1]['files'] += counters['files']
+                _stack[-1]['bytes'] += counters['bytes']
+            with open(log, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+    return func_wrapper
+
+
+def opened(fil):
+    """Count a file opened for reading by the current stage
+    """
+    if enabled and _stack:
+        _stack[-1]['files'] += 1
+        _stack[-1]['bytes'] += os.path.getsize(fil)
+
+
+def frames(n):
+    """Count frames processed by the current stage
+    """
+    if enabled and _stack:
+        _stack[-1]['frames'] += int(n)
+
+
+def summary(fil=None):
+    """Total metrics per stage from a JSON-lines log
+    """
+    a = pd.read_json(fil or log, lines=True)
+    out = a.groupby('stage')[['wall', 'cpu', 'files', 'bytes', 'frames']].sum()
+    out['calls'] = a.groupby('stage').size()
+    return out.sort_values('wall', ascending=False)
+
+
+def _tags(sig, args, kwargs):
+    """PST and pick a stage is called with
+    """
+    try:
+        a = sig.bind_partial(*args, **kwargs).arguments
+    except TypeError:
+        return {'pst':None, 'pik':None}
+    pik = a.get('pik', a.get('bed_pik'))
+    return {'pst':a.get('pst') if isinstance(a.get('pst'), str) else None,
+            'pik':pik if isinstance(pik, str) else None}
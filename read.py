@@ -3,12 +3,26 @@ Various tools to read WAIS data
 Author: Cyril Grima <cyril.grima@gmail.com>
 """
 
+import contextlib
+import fnmatch
+import functools
+import glob
 import icecap as icp
+import icecap.metrics
+import io
 import numpy as np
 import os
 import pandas as pd
 #import string
 import sys
+import tempfile
+
+
+TIMEBASE_CACHE_SIZE = 64 # Maximum number of FOC timebases kept in memory
+PLAN_CACHE_SIZE = 16 # Maximum number of interpolation plans kept in memory
+PIK_CACHE_SIZE = 16 # Maximum number of parsed pick files kept in memory
+CMP_NSAMPLES = 3200 # Samples per frame in CMP products (as pk3 3200 0 3200)
+CMP_DTYPE = '>i4' # Values of CMP products (power [dB*1000])
 
 
 def isfile(fil, verbose=True):
@@ -22,49 +36,157 @@ def isfile(fil, verbose=True):
     return out
 
 
+def savez(data, target):
+    """Save a dictionnary of arrays in a npz file (one array per column)
+    The file is written under a temporary name and then renamed, so that
+    readers and concurrent writers never see a partial file
+    """
+    data = {key:np.asarray(val) for key, val in data.items()}
+    data = {key:val.astype(str) if val.dtype == object else val
+            for key, val in data.items()}
+    with atomic(target, 'wb') as f:
+        np.savez(f, **data)
+    print('CREATED: ' + target)
+
+
+@contextlib.contextmanager
+def atomic(target, mode='w'):
+    """Open a temporary file next to target, renamed into target once
+    closed without error (deleted otherwise)
+    """
+    folder = os.path.dirname(target) or '.'
+    if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, target)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
 def continuous_vec(x):
-    """Modify a vector to make it continuous if needed. Designed to be
-    applied on time stamps crossing midnight
+    """Continuous copy of a vector (the input is not modified). Designed
+    to be applied on time stamps crossing midnight
     """
+    x = np.array(x, dtype=float)
     i = np.argmin(x)
     if i != 0:
         x[i:] = x[i:] + x[i-1]
     return x
 
 
+def interp_plan(time, target):
+    """Plan of a linear interpolation from time to target, as np.interp
+    does. It is computed once and applied to any number of streams sharing
+    time with interp_apply. time is made continuous (see continuous_vec),
+    target must already be (e.g. read.timebase)
+    OUTPUT
+        dict : {'index':left bracket in time, 'weight':weight of the right
+                bracket} for each target
+    """
+    time = continuous_vec(time)
+    index = np.searchsorted(time, target, side='right') - 1
+    index = np.clip(index, 0, max(time.size-2, 0)).astype(np.int32)
+    right = np.minimum(index+1, time.size-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = (target - time[index])/(time[right] - time[index])
+    weight = np.where(time[right] == time[index], 0., np.clip(weight, 0, 1))
+    weight[np.isnan(target)] = np.nan
+    return {'index':index, 'weight':weight}
+
+
+def interp_apply(plan, data):
+    """Apply an interpolation plan (see interp_plan) to a stream, or to
+    several streams at once (2D array, one stream per column)
+    """
+    data = np.asarray(data, dtype=float)
+    index = plan['index']
+    weight = plan['weight'] if data.ndim == 1 else plan['weight'][:, np.newaxis]
+    a = data[index]
+    b = data[np.minimum(index+1, len(data)-1)]
+    return np.where(weight == 0, a, np.where(weight == 1, b, a + weight*(b - a)))
+
+
+def timebase(pst, fil=None):
+    """FOC time (continuous decimal hours) of the 1-m frames of a PST
+    The parsed vector is cached per process on file path and modification
+    time, so that all readers share it. Do not modify it in place.
+    ARGUMENTS
+        pst : string (e.g. 'MIS/JKB2e/Y35a')
+        fil : string (ztim file of other frames, default: FOC ztim_DNhH)
+    """
+    p = icp.get.params()
+    foc_file = fil or p['foc_path'] + '/' + pst + '/ztim_DNhH'
+    if icp.read.isfile(foc_file) is False: return
+    return _timebase(foc_file, os.path.getmtime(foc_file))
+
+
+@functools.lru_cache(maxsize=TIMEBASE_CACHE_SIZE)
+def _timebase(fil, mtime):
+    """Cached FOC timebase (Least Recently Used policy)
+    """
+    out = continuous_vec(ztim(fil)['htim'])
+    out.flags.writeable = False
+    return out
+
+
+@icp.metrics.stage
 def norm(pst, instrument, stream, interp=False, **kwargs):
     """Read data streams from norm
     ARGUMENTS
         pst : string (e.g. 'MIS/JKB2e/Y35a')
         instrument : string (e.g. 'LAS')
-        stream : string (e.g. 'las_rng')
+        stream : string or list (e.g. 'las_rng'. Several streams of an
+                 instrument share their time and are returned as a 2D array)
         1m : bool (True is for interpolation to 1m sampling)
     """
     p = icp.get.params()
 
-    data_file = p['norm_path'] + '/' + pst + '/' + instrument + '_' + \
-                pst.split('/')[1][0:3] + 'a/' + stream
-    time_file = p['norm_path'] + '/' + pst + '/' + instrument + '_' + \
-               pst.split('/')[1][0:3] + 'a/syn_ztim'
+    folder = p['norm_path'] + '/' + pst + '/' + instrument + '_' + \
+             pst.split('/')[1][0:3] + 'a/'
+    streams = [stream] if isinstance(stream, str) else stream
+    data_files = [folder + i for i in streams]
+    time_file = folder + 'syn_ztim'
 
-    if icp.read.isfile(data_file) is False: return
+    for data_file in data_files:
+        if icp.read.isfile(data_file) is False: return
+        icp.metrics.opened(data_file)
     if icp.read.isfile(time_file) is False: return
 
-    data = np.genfromtxt(data_file)
-    time = ztim(time_file)['htim'].values
+    data = np.column_stack([np.genfromtxt(i) for i in data_files])
 
     if interp is True: #interpolate to 1-m sampling
+        foc_time = timebase(pst)
+        if foc_time is None: return
         foc_file = p['foc_path'] + '/' + pst + '/ztim_DNhH'
-
-        if icp.read.isfile(foc_file) is False: return
-
-        foc_time = ztim(foc_file)['htim'].values
-        data = np.interp(continuous_vec(foc_time), continuous_vec(time), data)
+        plan = _norm_plan(time_file, os.path.getmtime(time_file), foc_file,
+                          os.path.getmtime(foc_file))
+        data = interp_apply(plan, data)
         time = foc_time
+    else:
+        time = np.array(ztim(time_file)['htim'])
 
+    if isinstance(stream, str):
+        data = data[:, 0]
     return time, data
 
 
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def _norm_plan(time_file, mtime, foc_file, foc_mtime):
+    """Cached interpolation plan from the time of a norm instrument to the
+    FOC time (shared by all the streams of the instrument)
+    """
+    out = interp_plan(ztim(time_file)['htim'], _timebase(foc_file, foc_mtime))
+    for i in out.values():
+        i.flags.writeable = False
+    return out
+
+
+@icp.metrics.stage
 def tpro(pst, typ, fil, interp=True, **kwargs):
     """Read tpro or treg file
     !!!!!!!!!!!!!!!!!!
@@ -77,24 +199,18 @@ def tpro(pst, typ, fil, interp=True, **kwargs):
     data_file = p['tpro_path'] + '/' + pst + '/' + typ + '/' + fil + '.bin'
     if icp.read.isfile(data_file) is False: return
 
-    os.system('zvert ' + data_file + ' > tmp.tab')
-    data = np.genfromtxt('tmp.tab')[:,-1]
-    time = ztim('tmp.tab')['htim'].values
-    os.system('rm tmp.tab')
+    time, data = zbin(data_file, column=-1)
 
     if interp is True: #interpolate to 1-m sampling
-        foc_file = p['foc_path'] + '/' + pst + '/ztim_DNhH'
-
-        if icp.read.isfile(foc_file) is False: return
-
-        foc_time = ztim(foc_file)['htim'].values
-        data = np.interp(continuous_vec(foc_time), continuous_vec(time), data)
-        #data = np.interp(foc_time, time, data)
+        foc_time = timebase(pst)
+        if foc_time is None: return
+        data = interp_apply(interp_plan(time, foc_time), data)
         time = foc_time
 
     return time, data
 
 
+@icp.metrics.stage
 def targ(pst, folder, typ, fil, interp=True, column=-1, **kwargs):
     """Read a binary file from targ
     ARGUMENT examples
@@ -102,49 +218,162 @@ def targ(pst, folder, typ, fil, interp=True, column=-1, **kwargs):
         folder : 'treg'
         typ : 'TRJ_JKB0'
         fil : 'ztim_llzrphaaas'
+        column : -1 or [-7, -1] (several columns are read in a single pass
+                 and returned as a 2D array)
     """
     p = icp.get.params()
     data_file = p[folder+'_path'] + '/' + pst + '/' + typ + '/' + fil + '.bin'
     if icp.read.isfile(data_file) is False: return
 
-    os.system('zvert ' + data_file + ' > tmp.tab')
-    data = np.genfromtxt('tmp.tab')[:,column]
-    time = ztim('tmp.tab')['htim'].values
-    os.system('rm tmp.tab')
+    time, data = zbin(data_file, column=column)
 
     if interp is True: #interpolate to 1-m sampling
-        foc_file = p['foc_path'] + '/' + pst + '/ztim_DNhH'
+        foc_time = timebase(pst)
+        if foc_time is None: return
+        data = interp_apply(interp_plan(time, foc_time), data)
+        time = foc_time
 
-        if icp.read.isfile(foc_file) is False: return
+    return time, data
 
-        foc_time = ztim(foc_file)['htim'].values
-        data = np.interp(continuous_vec(foc_time), continuous_vec(time), data)
-        #data = np.interp(foc_time, time, data)
-        time = foc_time
 
+@icp.metrics.stage
+def zbin(fil, column=-1):
+    """Read a binary ztim-format file (.bin) without zvert
+    Records are decoded from a memory map, their layout being given by the
+    file name (e.g. 'ztim_llzrphsaaa' is a ztim followed by 10 values).
+    Fall back on zvert if this layout does not match the file size or
+    does not decode into plausible times.
+    ARGUMENTS
+        fil : string (full path + file name to read)
+        column : int or list of int (column(s) as in the zvert text output,
+                 i.e. the ztim occupies the 3 first columns)
+    OUTPUT
+        time, data : decimal hours, values (2D if column is a list)
+    """
+    if icp.read.isfile(fil) is False: return
+    icp.metrics.opened(fil)
+    a = _zbin_map(fil)
+    if a is None:
+        a = _zvert(fil)
+    ztim, values = a
+
+    cols = np.arange(len(values) + 3)[column] - 3
+    if np.any(cols < 0):
+        raise ValueError('column ' + str(column) + ' is part of the ztim')
+    if np.ndim(cols) == 0:
+        data = values[cols]
+    else:
+        data = np.column_stack([values[i] for i in cols])
+    time = np.array(ztim, dtype=float)*24/(86400*1e4)
     return time, data
 
 
+ZBIN_ZTIM = [('year', '>i2'), ('day', '>i2'), ('ztim', '>i4')] # .bin record header
+ZBIN_VALUE = '>f8' # .bin record values
+
+
+def _zbin_map(fil):
+    """Memory map a .bin file. Return the ztim and a list of zero-copy
+    views on each value column, or None if the layout is not recognized
+    """
+    name = os.path.basename(fil).split('.')[0]
+    if not name.startswith('ztim_'):
+        return
+    nval = len(name) - len('ztim_')
+    dtype = np.dtype(ZBIN_ZTIM + [('v%d' % i, ZBIN_VALUE) for i in range(nval)])
+    size = os.path.getsize(fil)
+    if size == 0 or size % dtype.itemsize != 0:
+        return
+    a = np.memmap(fil, dtype=dtype, mode='r')
+    if not _zbin_valid(a):
+        return
+    return a['ztim'], [a['v%d' % i] for i in range(nval)]
+
+
+def _zbin_valid(a):
+    """Whether the ztim decoded from a .bin file is plausible (year, day in
+    the year, time in the day and time increasing), i.e. whether the
+    assumed record layout is the one of the file
+    """
+    year, day, ztim = a['year'], a['day'], a['ztim']
+    if np.any((year < 1970) | (year > 2100) | (day < 1) | (day > 366) |
+              (ztim < 0) | (ztim >= 86400*10000)):
+        return False
+    t = (year.astype(np.int64)*1000 + day)*86400*10000 + ztim
+    return bool(np.all(np.diff(t) >= 0))
+
+
+def _zvert(fil):
+    """Convert a .bin file with zvert in a private temporary file. Return
+    the ztim and a list of value columns
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        tab = os.path.join(folder, 'zvert.tab')
+        os.system('zvert ' + fil + ' > ' + tab)
+        a = ztim(tab)
+    return a[5].values, [a[i].values for i in a.columns[7:-1]]
+
+
+@icp.metrics.stage
 def ztim(fil):
     """Read time in a ztim-format file
     ARGUMENTS
         fil : string (full path + file name to read)
+    OUTPUT
+        DataFrame with year, day and ztim in columns 1, 3 and 5, any extra
+        value in columns 7 and more, and the decimal hour in 'htim'
     """
     if icp.read.isfile(fil) is False: return
-    out = pd.read_csv(fil, sep='\(|\)| |,', header=None, engine='python')
-    a = np.array(out)
-    htim = (a[:,3] - a[:,3])*24 + a[:,5]*24/(86400*1e4)
+    icp.metrics.opened(fil)
+    try:
+        out = _ztim_c(fil)
+    except ValueError: # ragged or unexpected layout
+        out = _ztim_regex(fil)
+    a = np.array(out[5], dtype=float)
+    htim = a*24/(86400*1e4)
     out['htim'] = htim
     return out
 
 
-def pik(pst, pik, process=None, product='MagHiResInco1', **kwargs):
+_ZTIM_SEP = bytes.maketrans(b'(),', b'   ')
+
+
+def _ztim_c(fil):
+    """Decode a ztim-format file with the C parser of pandas. Brackets and
+    commas are turned into blanks so that lines like '(2009, 005, 0123456789)'
+    become whitespace-separated records. The output mimics the column layout
+    of _ztim_regex (empty separator columns are filled with nans)
+    """
+    with open(fil, 'rb') as f:
+        buf = f.read().translate(_ZTIM_SEP)
+    a = pd.read_csv(io.BytesIO(buf), sep=r'\s+', header=None, engine='c')
+    if a.shape[1] < 3:
+        raise ValueError(fil + ' is not a ztim file')
+    nan = np.full(a.shape[0], np.nan)
+    out = {0:nan, 1:a[0].values, 2:nan, 3:a[1].values, 4:nan, 5:a[2].values, 6:nan}
+    for i in a.columns[3:]:
+        out[i+4] = a[i].values
+    return pd.DataFrame(out)
+
+
+def _ztim_regex(fil):
+    """Decode a ztim-format file with the python regex parser of pandas
+    (slow, but tolerant to any layout)
+    """
+    return pd.read_csv(fil, sep='\\(|\\)| |,', header=None, engine='python')
+
+
+@icp.metrics.stage
+def pik(pst, pik, process=None, product='MagHiResInco1', all_columns=False, **kwargs):
     """Read pick files
+    The parsed records are cached per process on file path and modification
+    time. Do not modify them in place.
     ARGUMENTS
         pst : string (e.g. 'MIS/JKB2e/Y35a')
         pik : string (e.g. 'srf_elg')
         process : string (e.g. 'pik1.1m.RADnh3')
         product : string (e.g. 'MagHiResInco1')
+        all_columns : bool (True to return every column of the P records)
     OUTPUT
         list : list (Y coordinate, value)
     """
@@ -153,12 +382,128 @@ def pik(pst, pik, process=None, product='MagHiResInco1', **kwargs):
         process = p['process']
     fil = p['pik_path'].replace( p['process'], '') + process + '/' + pst + '/' + product + '.' + pik
     if icp.read.isfile(fil) is False: return
-    os.system('grep P ' + fil + ' > ' + p['code_path'] + '/.read_pik.tmp')
-    out = np.genfromtxt('.read_pik.tmp', delimiter='\t')
-    os.system('rm ' + p['code_path'] + '/.read_pik.tmp')
+    icp.metrics.opened(fil)
+    out = _pik_cached(fil, os.path.getmtime(fil))
+    if all_columns is True:
+        return out
     return out[:, 2], out[:, 3] # Y coordinate, value
 
 
+@icp.metrics.stage
+def cmp(pst, product='MagHiResInco1', process=None, nsamples=CMP_NSAMPLES,
+        dtype=CMP_DTYPE, **kwargs):
+    """Memory-map a CMP radargram. Nothing is read until values are
+    accessed
+    ARGUMENTS
+        pst : string (e.g. 'MIS/JKB2e/Y35a')
+        product : string (e.g. 'MagHiResInco1')
+        process : string (e.g. 'pik1.1m.RADnh3')
+        nsamples : int (samples per frame)
+        dtype : string (type of the values)
+    OUTPUT
+        memmap : read-only array (frames x samples)
+    """
+    p = icp.get.params()
+    if process is None:
+        process = p['process']
+    fil = p['cmp_path'].replace( p['process'], '') + process + '/' + pst + '/' + product
+    if icp.read.isfile(fil) is False: return
+    icp.metrics.opened(fil)
+    data = np.memmap(fil, dtype=dtype, mode='r')
+    return data[:data.size//nsamples*nsamples].reshape(-1, nsamples)
+
+
+def echo(data, frame, sample, window=0, chunk=100000):
+    """Echo power along a pick line in a radargram, at the maximum within
+    +/- window samples of the pick. Frames out of the radargram and
+    missing samples give nans. The radargram is read by chunks of frames
+    ARGUMENTS
+        data : array (frames x samples, e.g. from read.cmp)
+        frame : array (frame of each pick)
+        sample : array (sample of each pick)
+        window : int (half-width of the maximum search [samples])
+    OUTPUT
+        sample : array (sample of the maximum)
+        value : array (power at the maximum)
+    """
+    frame = np.asarray(frame, dtype=float)
+    sample = np.asarray(sample, dtype=float)
+    out_sample = np.full(frame.size, np.nan)
+    out_val = np.full(frame.size, np.nan)
+    ok = np.flatnonzero(np.isfinite(frame) & np.isfinite(sample) &
+                        (frame >= 0) & (frame < data.shape[0]))
+    offset = np.arange(-window, window+1)
+    for k in range(0, ok.size, chunk):
+        w = ok[k:k+chunk]
+        f = frame[w].astype(int)
+        col = np.clip(sample[w].astype(int)[:, np.newaxis] + offset, 0, data.shape[1]-1)
+        val = data[f[:, np.newaxis], col]
+        j = np.argmax(val, axis=1)
+        out_sample[w] = col[np.arange(w.size), j]
+        out_val[w] = val[np.arange(w.size), j]
+    icp.metrics.frames(ok.size)
+    return out_sample, out_val
+
+
+@icp.metrics.stage
+def piks(pst, pattern='*', process=None, product='MagHiResInco1', **kwargs):
+    """Read every pick file of a PST for a given product
+    ARGUMENTS
+        pst : string (e.g. 'MIS/JKB2e/Y35a')
+        pattern : string (pick names to read, e.g. 'srf_*')
+    OUTPUT
+        dict : {pick name: (Y coordinate, value)}
+    """
+    products, piks = icp.get.pik(pst, process=process)
+    out = {}
+    for product_i, pik_i in zip(products, piks):
+        if product_i == product and fnmatch.fnmatch(pik_i, pattern):
+            out[pik_i] = pik(pst, pik_i, process=process, product=product, **kwargs)
+    return out
+
+
+@functools.lru_cache(maxsize=PIK_CACHE_SIZE)
+def _pik_cached(fil, mtime):
+    """Cached P records of a pick file (Least Recently Used policy)
+    """
+    out = _pik_records(fil)
+    out.flags.writeable = False
+    return out
+
+
+def _pik_records(fil):
+    """Parse the lines of a pick file that contain a 'P' (as 'grep P' does)
+    into a 2D array. Non-numeric fields are nans
+    """
+    with open(fil, 'rb') as f:
+        buf = b''.join([i for i in f if b'P' in i])
+    if not buf:
+        return np.empty((0, 4))
+    a = pd.read_csv(io.BytesIO(buf), sep='\t', header=None, engine='c')
+    return np.array(a.apply(pd.to_numeric, errors='coerce'), dtype=float)
+
+
+def table(fil, names):
+    """Read the columns of a product file, either tab-separated text or
+    binary (npy with named columns, as written by do.save with binary).
+    The format is detected from the file content. Binary columns are
+    memory-mapped
+    ARGUMENTS
+        fil : string (full path + file name to read)
+        names : list (column names, in the order of the text columns)
+    OUTPUT
+        dict : {name: array}
+    """
+    with open(fil, 'rb') as f:
+        magic = f.read(6)
+    if magic == b'\x93NUMPY':
+        a = np.load(fil, mmap_mode='r')
+        return {key:a[key] for key in names}
+    a = np.atleast_2d(np.genfromtxt(fil, delimiter='\t'))
+    return {key:a[:, i] for i, key in enumerate(names)}
+
+
+@icp.metrics.stage
 def rsr(pst, pik, process=None, product='MagHiResInco1', **kwargs):
     """Read an rsr file
     """
@@ -167,12 +512,12 @@ def rsr(pst, pik, process=None, product='MagHiResInco1', **kwargs):
         process = p['process']
     fil = p['rsr_path'].replace( p['process'], '') + process + '/' + pst + '/' + product + '.' + pik
     if icp.read.isfile(fil) is False: return
+    icp.metrics.opened(fil)
 
-    a = np.genfromtxt(fil, delimiter='\t')
-    out = {'xa':a[:,0], 'xo':a[:,1], 'xb':a[:,2], 'pt':a[:,3],'pc':a[:,4], 'pn':a[:,5], 'mu':a[:,6], 'crl':a[:,7], 'chisqr':a[:,8] }
-    return out
+    return table(fil, ['xa', 'xo', 'xb', 'pt', 'pc', 'pn', 'mu', 'crl', 'chisqr'])
 
 
+@icp.metrics.stage
 def surface_coefficients(pst, pik, process=None, product='MagHiResInco1', **kwargs):
     """Read a surface_coefficients file
     """
@@ -181,12 +526,12 @@ def surface_coefficients(pst, pik, process=None, product='MagHiResInco1', **kwar
         process = p['process']
     fil = p['rsr_path'].replace( p['process'], '') + process + '/' + pst + '/' + product + '.' + pik + '.surface_coefficients'
     if icp.read.isfile(fil) is False: return
+    icp.metrics.opened(fil)
 
-    a = np.genfromtxt(fil, delimiter='\t')
-    out = {'Rsc':a[:,0], 'Rsn':a[:,1], }
-    return out
+    return table(fil, ['Rsc', 'Rsn'])
 
 
+@icp.metrics.stage
 def surface_properties(pst, pik, process=None, product='MagHiResInco1', **kwargs):
     """Read a surface_coefficients file
     """
@@ -195,11 +540,11 @@ def surface_properties(pst, pik, process=None, product='MagHiResInco1', **kwargs
         process = p['process']
     fil = p['rsr_path'].replace( p['process'], '') + process + '/' + pst + '/' + product + '.' + pik + '.surface_properties'
     if icp.read.isfile(fil) is False: return
-    a = np.genfromtxt(fil, delimiter='\t')
-    out = {'sh':a[:,0], 'eps':a[:,1], 'flag':a[:,2]}
-    return out
+    icp.metrics.opened(fil)
+    return table(fil, ['sh', 'eps', 'flag'])
 
 
+@icp.metrics.stage
 def bed_coefficients(pst, pik, process=None, product='MagHiResInco1', **kwargs):
     """Read a bed_coefficients file
     """
@@ -208,7 +553,35 @@ def bed_coefficients(pst, pik, process=None, product='MagHiResInco1', **kwargs):
         process = p['process']
     fil = p['rsr_path'].replace( p['process'], '') + process + '/' + pst + '/' + product + '.' + pik + '.bed_coefficients'
     if icp.read.isfile(fil) is False: return
+    icp.metrics.opened(fil)
 
-    a = np.genfromtxt(fil, delimiter='\t')
-    out = {'Rbc':a[:,0], 'Rbn':a[:,1], }
-    return out
+    return table(fil, ['Rbc', 'Rbn'])
+
+
+@icp.metrics.stage
+def gather(fil=None, columns=None, pattern='*'):
+    """Read data gathered by do.gather
+    ARGUMENTS
+        fil : string (partition folder, default: <season>_gather)
+        columns : list (columns to read, default: all)
+        pattern : string (partitions to read, e.g. 'MIS_JKB2e_*')
+    OUTPUT
+        DataFrame
+    """
+    frames = list(gather_iter(fil=fil, columns=columns, pattern=pattern))
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+
+def gather_iter(fil=None, columns=None, pattern='*'):
+    """Iterate over the partitions written by do.gather, one DataFrame per
+    PST and pick. Only the requested columns are loaded
+    """
+    if fil is None:
+        fil = icp.get.params()['season'] + '_gather'
+    for partition in sorted(glob.glob(fil + '/' + pattern + '.npz')):
+        icp.metrics.opened(partition)
+        with np.load(partition) as a:
+            keys = a.files if columns is None else columns
+            yield pd.DataFrame({key:a[key] for key in keys})
@@ -0,0 +1,149 @@
+"""
+Synthetic WAIS hierarchy, to exercise icecap without the real data
+Author: Cyril Grima <cyril.grima@gmail.com>
+"""
+
+import icecap as icp
+import icecap.geo
+import numpy as np
+import os
+import pandas as pd
+
+
+def write_ztim(fil, ztim, year=2009, day=5):
+    """Write a ztim-format text file
+    ARGUMENTS
+        fil : string (full path + file name)
+        ztim : array of int (time [1e-4 s] of each record)
+    """
+    with open(fil, 'w') as f:
+        f.write(''.join(['(%d, %03d, %010d)\n' % (year, day, i) for i in ztim]))
+
+
+def write_zbin(fil, ztim, values, year=2009, day=5):
+    """Write a binary ztim-format file (.bin) as decoded by read.zbin
+    """
+    values = np.atleast_2d(np.asarray(values).T).T
+    dtype = np.dtype(icp.read.ZBIN_ZTIM +
+                     [('v%d' % i, icp.read.ZBIN_VALUE) for i in range(values.shape[1])])
+    a = np.zeros(len(ztim), dtype=dtype)
+    a['year'], a['day'], a['ztim'] = year, day, ztim
+    for i in range(values.shape[1]):
+        a['v%d' % i] = values[:, i]
+    a.tofile(fil)
+
+
+def tree(root, season='ICP4', process='pik1.1m.RADnh3', npst=4, nframes=20000,
+         pik='srf_syn', product='MagHiResInco1', winsize=1000, sampling=250,
+         seed=0):
+    """Build a synthetic WAIS hierarchy as expected by get.params
+    PSTs are straight transects flown at ~90 m/s across the same area, so
+    that they intersect each other
+    ARGUMENTS
+        root : string (root of the hierarchy, i.e. $WAIS)
+        npst : int (number of PSTs)
+        nframes : int (number of 1-m frames per PST)
+        pik : string (name of the synthetic surface pick)
+    OUTPUT
+        string : code path (to be used as working directory)
+    """
+    rng = np.random.default_rng(seed)
+    code_path = '/'.join([root, 'code/xtra', season, 'RSR', process])
+    os.makedirs(code_path, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(code_path)
+    try:
+        p = icp.get.params()
+    finally:
+        os.chdir(cwd)
+
+    psts = ['SYN/JKB2e/X%02da' % i for i in range(npst)]
+    os.makedirs(os.path.dirname(p['season_flight_pst']), exist_ok=True)
+    with open(p['season_flight_pst'], 'w') as f:
+        for i, pst in enumerate(psts):
+            f.write('%s F%02d %s\n' % (pst, i, season))
+
+    for i, pst in enumerate(psts):
+        ac = pst.split('/')[1][0:3] + 'a'
+        t0 = 100000000 + i*20000000
+
+        # FOC timebase (1 frame per meter at 90 m/s)
+        foc_ztim = t0 + np.round(np.arange(nframes)*1e4/90.).astype(int)
+        _write(p['foc_path'] + '/' + pst + '/ztim_DNhH', write_ztim, foc_ztim)
+
+        # Track across the area, with a heading depending on the PST
+        heading = np.pi*i/npst + rng.uniform(0, .1)
+        s = np.arange(nframes) - nframes/2.
+        x = 309000 + s*np.cos(heading)
+        y = -1276500 + s*np.sin(heading)
+        lat, lon = icp.geo.ps2ll(x, y)
+
+        # Norm streams at 10 Hz
+        norm_ztim = np.arange(foc_ztim[0] - 2000, foc_ztim[-1] + 2000, 1000)
+        fi = np.interp(norm_ztim, foc_ztim, np.arange(nframes))
+        streams = {'GPS':{'lon_ang':np.interp(fi, np.arange(nframes), lon),
+                          'lat_ang':np.interp(fi, np.arange(nframes), lat)},
+                   'AVN':{'roll_ang':rng.normal(0, .5, fi.size)},
+                   'LAS':{'las_rng':1000 + 50*np.sin(fi/5000.) + rng.normal(0, .1, fi.size)}}
+        for instrument, data in streams.items():
+            folder = p['norm_path'] + '/' + pst + '/' + instrument + '_' + ac
+            _write(folder + '/syn_ztim', write_ztim, norm_ztim)
+            for stream, val in data.items():
+                np.savetxt(folder + '/' + stream, val, fmt='%.7f')
+
+        # Trajectory in treg (l l z r p h s a a a)
+        trj = np.zeros((norm_ztim.size, 10))
+        trj[:, 0], trj[:, 1] = streams['GPS']['lat_ang'], streams['GPS']['lon_ang']
+        trj[:, 3] = streams['AVN']['roll_ang']
+        trj[:, -1] = 2000 + 200*np.cos(fi/3000.)
+        _write(p['treg_path'] + '/' + pst + '/TRJ_JKB0/ztim_llzrphsaaa.bin', write_zbin,
+               norm_ztim, trj)
+
+        # Sweeps
+        _write(p['sweep_path'] + '/' + pst + '/sweeps', lambda fil: open(fil, 'w').close())
+
+        # Surface pick (power in dB*1000 of a Rician echo)
+        amp = np.abs(.3 + rng.normal(0, .05, nframes) + 1j*rng.normal(0, .05, nframes))
+        val = np.round(20*np.log10(amp)*1000)
+        y = np.arange(nframes)
+        sample = np.round(660 + np.interp(y, fi, streams['LAS']['las_rng'])/1.5).astype(int)
+        _write(p['pik_path'] + '/' + pst + '/' + product + '.' + pik, _write_pik, sample, y, val)
+
+        # RSR output
+        w = _frames(nframes, winsize, sampling)
+        n = w['xa'].size
+        pc = -11 + rng.normal(0, .5, n)
+        pn = pc - 20 + rng.normal(0, 1, n)
+        pt = 10*np.log10(10**(pc/10) + 10**(pn/10))
+        data = pd.DataFrame({'1':w['xa'], '2':w['xo'], '3':w['xb'], '4':pt, '5':pc, '6':pn,
+                             '7':rng.uniform(1, 30, n), '8':rng.uniform(.9, 1, n),
+                             '9':rng.uniform(0, .1, n)})
+        _write(p['rsr_path'] + '/' + pst + '/' + product + '.' + pik,
+               lambda fil: data.to_csv(fil, sep='\t', float_format='%.7f',
+                                       na_rep='nan', header=False, index=False))
+
+    return code_path
+
+
+def _write(fil, writer, *args):
+    """Create the folder of a file and write it
+    """
+    os.makedirs(os.path.dirname(fil), exist_ok=True)
+    writer(fil, *args)
+
+
+def _write_pik(fil, sample, y, val):
+    """Write P records of a pick file
+    """
+    with open(fil, 'w') as f:
+        for i, j, k in zip(sample, y, val):
+            f.write('P\t%d\t%d\t%d\n' % (i, j, k))
+
+
+def _frames(n, winsize, sampling):
+    """Along-track windows, as rsr.run.frames
+    """
+    xa = np.arange(n)[:int(n-winsize):int(sampling)]
+    xb = xa + winsize - 1
+    return {'xa':xa, 'xb':xb, 'xo':xa + (xb-xa)/2.}
+
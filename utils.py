@@ -8,6 +8,7 @@ Various tools to manipulate WAIS data
 Author: Cyril Grima <cyril.grima@gmail.com>
 """
 
+import icecap as icp
 import numpy as np
 import pandas as pd
 import os
@@ -59,10 +60,7 @@ def bathymetry(pst, ext1, ext2, fit_model='hk', inv='spm', save=True):
     delay[np.isnan(delay)] = 0.
 
     # Results    
-    z = [dns_depth(eps[i], delay[i]) for i, val in enumerate(eps)]
-    depth = [i[0] for i in z]
-    uncertainty = [i[1] for i in z]
-    dns_at_depth = [i[2] for i in z]
+    depth, uncertainty, dns_at_depth = icp.bathymetry.depth(eps, delay, bdw=bdw)
 
     out = {'lat':lat, 'lon':lon, 'eps':eps, 'sh':sh, 'crl':crl, 'delay':delay, 
            'uncertainty':uncertainty, 'depth':depth, 'dns_at_depth':dns_at_depth,
@@ -80,6 +78,7 @@ def bathymetry(pst, ext1, ext2, fit_model='hk', inv='spm', save=True):
 def dns_depth(eps, delay, z=np.linspace(0, 5000, 5000), zp=[19., 129.]):
     """Give an estimation for the depth of a subsurface echo and based on the surface density.
     Assumes a Sorge's law depth/density profile
+    (see bathymetry.depth for a vectorized version)
 
     Arguments
     ---------